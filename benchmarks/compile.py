@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Benchmark compiling many headers in parallel.
+
+Generates a number of headers and times parsing and resolving them one after
+another with StructureSet, and with StructureSet.compile_many() across a
+growing number of worker processes. Wall-clock time should drop roughly in
+proportion to the number of cores available.
+
+    python benchmarks/compile.py [headers [workers...]]
+"""
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from destructor import *
+from typedefs import header
+
+# typedefs in each header
+SIZE = 200
+
+
+def main(count, workers):
+    sources = [header(SIZE) + '\nstruct h%d { int x; };' % i for i in range(count)]
+
+    start = time.time()
+    for source in sources:
+        ss = StructureSet(source)
+        for i in range(len(ss.names)):
+            ss.layout(i)
+    serial = time.time() - start
+    print('%8s %10s' % ('workers', 'seconds'))
+    print('%8s %10.3f' % ('serial', serial))
+
+    for n in workers:
+        start = time.time()
+        StructureSet.compile_many(sources=sources, workers=n)
+        print('%8d %10.3f' % (n, time.time() - start))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    cpus = multiprocessing.cpu_count()
+    workers = [int(a) for a in sys.argv[2:]] or sorted(set([1, 2, 4, cpus]))
+    main(count, workers)
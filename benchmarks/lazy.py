@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Benchmark a lazy StructureSet against an eager one.
+
+For generated headers of a growing size, times creating a StructureSet and
+instantiating a dozen of its structs, and measures the memory held by the set
+afterwards (on Python 3). With `lazy` set, both should depend on the structs
+that are used rather than on the size of the header.
+
+    python benchmarks/lazy.py [sizes...]
+"""
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from destructor import *
+from typedefs import header, CHAIN
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+USED = 12
+
+
+def load(source, n, lazy):
+    ss = StructureSet(source, lazy=lazy)
+    for i in range(0, n, n // USED):
+        ss.struct_named('s%d' % (i - i % CHAIN))()
+    return ss
+
+
+def run(source, n, lazy):
+    gc.collect()
+    start = time.time()
+    load(source, n, lazy)
+    elapsed = time.time() - start
+
+    # measure memory separately, tracing allocations slows everything down
+    memory = 0
+    if tracemalloc:
+        gc.collect()
+        tracemalloc.start()
+        ss = load(source, n, lazy)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return elapsed, memory
+
+
+def main(sizes):
+    print('%10s %6s %10s %10s' % ('typedefs', 'lazy', 'seconds', 'KB'))
+    for n in sizes:
+        source = header(n)
+        for lazy in (False, True):
+            t, mem = run(source, n, lazy)
+            print('%10d %6s %10.4f %10d' % (n, lazy, t, mem // 1024))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [1000, 4000, 16000])
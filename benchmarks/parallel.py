@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Benchmark parallel parsing of a file of records.
+
+Writes a file of records, then times parsing it with parse_many() in this
+process and with parse_parallel() across a growing number of worker
+processes. Throughput should scale with the number of cores available.
+
+    python benchmarks/parallel.py [records [workers...]]
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from destructor import *
+
+
+class Record(Structure):
+    _source = """
+    struct Record {
+        unsigned int        id;
+        unsigned short      kind;
+        unsigned short      flags;
+        long long           timestamp;
+        double              value;
+        char                name[16];
+        unsigned char       payload[8];
+    };
+    """
+
+
+def main(records, workers):
+    layout = Record.layout_for()
+    fd, filename = tempfile.mkstemp(suffix='.bin')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(bytearray(os.urandom(layout.size)) * records)
+
+        start = time.time()
+        with open(filename, 'rb') as f:
+            Record.parse_many(f.read())
+        serial = time.time() - start
+        print('%8s %10s %12s' % ('workers', 'seconds', 'records/s'))
+        print('%8s %10.3f %12d' % ('serial', serial, records / serial))
+
+        for n in workers:
+            start = time.time()
+            Record.parse_parallel(filename, workers=n)
+            elapsed = time.time() - start
+            print('%8d %10.3f %12d' % (n, elapsed, records / elapsed))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    cpus = multiprocessing.cpu_count()
+    workers = [int(a) for a in sys.argv[2:]] or sorted(set([1, 2, 4, cpus]))
+    main(records, workers)
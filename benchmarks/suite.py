@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+The destructor benchmark suite.
+
+Measures:
+    construct       creating instances of a Structure subclass from `_source`,
+                    for a new class (parsing the source) and for one whose
+                    layout has been resolved
+    structureset    creating a StructureSet and resolving every struct for
+                    synthetic headers of increasing size
+    parse, pack     parse() and packed throughput for narrow, wide, nested and
+                    array-heavy structs in both modes and endiannesses
+    read, write     read() and write() throughput per record, and
+                    iter_records() and write_many() throughput, to a real file
+
+Run the suite and save the results as JSON:
+
+    python benchmarks/suite.py run -o before.json
+
+Then compare two runs, exiting with a non-zero status if anything got more
+than `--threshold` percent slower:
+
+    python benchmarks/suite.py compare before.json after.json --threshold 10
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from destructor import *
+from typedefs import header
+
+TYPES = ['char', 'unsigned char', 'short', 'unsigned short', 'int', 'unsigned int', 'long', 'unsigned long',
+         'long long', 'unsigned long long', 'float', 'double', 'void *']
+
+SHAPES = {
+    'narrow': """
+        struct narrow {
+            int                 a;
+            unsigned short      b;
+            char                c;
+            unsigned char       d;
+        };
+    """,
+    'wide': 'struct wide {\n%s\n};' % '\n'.join('    %s m%d;' % (TYPES[i % len(TYPES)], i) for i in range(128)),
+    'nested': """
+        struct inner {
+            int                 a;
+            long                b;
+        };
+        struct middle {
+            struct inner        i1;
+            struct inner        i2;
+            short               s;
+        };
+        struct nested {
+            struct middle       m1;
+            struct middle       m2;
+            unsigned int        x;
+        };
+    """,
+    'array': """
+        struct array {
+            unsigned int        a[32];
+            char                name[64];
+            double              d[8];
+            short               s[16];
+            unsigned long       p[4];
+        };
+    """,
+}
+
+MODES = [MODE_ILP32, MODE_LP64]
+ENDIANS = [ENDIAN_LITTLE, ENDIAN_BIG]
+HEADER_SIZES = [100, 400, 1600]
+
+
+class Suite(object):
+    """
+    Runs benchmarks and collects their results. Each result has an id made up
+    of the benchmark name and its parameters, a value and a unit. Values in
+    "ops/s" and "records/s" are better when higher, and values in "s" when
+    lower.
+    """
+    def __init__(self, quick=False, pattern=None):
+        self.quick = quick
+        self.pattern = pattern
+        self.results = []
+
+    def wanted(self, id):
+        return self.pattern is None or self.pattern in id
+
+    def record(self, id, value, unit):
+        self.results.append({'id': id, 'value': value, 'unit': unit})
+        print('%-60s %14.6g %s' % (id, value, unit))
+        sys.stdout.flush()
+
+    def rate(self, id, func, number=None):
+        # record the best rate of calling `func` out of a few repeats
+        if not self.wanted(id):
+            return
+        number = number or (2000 if self.quick else 20000)
+        best = min(timeit.Timer(func).repeat(3 if self.quick else 5, number))
+        self.record(id, number / best, 'ops/s')
+
+    def best(self, func, repeat=None):
+        # the best time it takes to call `func`
+        times = []
+        for i in range(repeat or (2 if self.quick else 5)):
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        return min(times)
+
+    def duration(self, id, func, repeat=None):
+        if self.wanted(id):
+            self.record(id, self.best(func, repeat), 's')
+
+    def throughput(self, id, func, count):
+        # record the rate at which `func` processes `count` records
+        if self.wanted(id):
+            self.record(id, count / self.best(func), 'records/s')
+
+    def run(self):
+        self.construct()
+        self.structureset()
+        self.parse_pack()
+        self.io()
+
+    def construct(self):
+        source = SHAPES['wide']
+
+        def first():
+            type('Wide', (Structure,), {'_source': source})()
+        self.duration('construct[first]', first, 3 if self.quick else 10)
+
+        cls = type('Wide', (Structure,), {'_source': source})
+        cls()
+        self.rate('construct[cached]', cls)
+
+    def structureset(self):
+        for n in HEADER_SIZES:
+            source = header(n)
+
+            def load():
+                ss = StructureSet(source)
+                for i in range(len(ss.names)):
+                    ss.layout(i)
+            self.duration('structureset[typedefs=%d]' % n, load)
+
+    def parse_pack(self):
+        for shape in sorted(SHAPES):
+            cls = type(shape, (Structure,), {'_source': SHAPES[shape], '_name': shape})
+            for mode in MODES:
+                for endian in ENDIANS:
+                    s = cls(mode=mode, endian=endian)
+                    data = bytes(bytearray(i % 256 for i in range(s.size)))
+                    s.parse(data)
+                    params = 'shape=%s,mode=%s,endian=%s' % (shape, mode, endian)
+                    self.rate('parse[%s]' % params, lambda: s.parse(data))
+                    self.rate('pack[%s]' % params, lambda: s.packed)
+
+    def io(self):
+        cls = type('wide', (Structure,), {'_source': SHAPES['wide']})
+        count = 1000 if self.quick else 10000
+        s = cls()
+        data = bytes(bytearray(i % 256 for i in range(s.size)))
+        s.parse(data)
+        records = [cls(data) for i in range(count)]
+        fd, filename = tempfile.mkstemp(suffix='.bin')
+        os.close(fd)
+        try:
+            def write():
+                with open(filename, 'wb') as f:
+                    for i, rec in enumerate(records):
+                        rec.write(f, i * s.size)
+
+            def write_many():
+                with open(filename, 'wb') as f:
+                    cls.write_many(f, records)
+
+            def read():
+                with open(filename, 'rb') as f:
+                    for i in range(count):
+                        s.read(f, i * s.size)
+
+            def iter_records():
+                with open(filename, 'rb') as f:
+                    for rec in cls.iter_records(f):
+                        pass
+
+            for name, func in [('write', write), ('write_many', write_many), ('read', read),
+                               ('iter_records', iter_records)]:
+                self.throughput('io[%s]' % name, func, count)
+        finally:
+            os.remove(filename)
+
+
+def metadata():
+    return {
+        'python':       platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform':     platform.platform(),
+        'machine':      platform.machine(),
+        'time':         time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(old, new, threshold):
+    """
+    Print the change in each result between two runs and return the ids of
+    results that got more than `threshold` percent worse.
+    """
+    for key in ('python', 'implementation', 'machine'):
+        if old['meta'].get(key) != new['meta'].get(key):
+            print('warning: runs have a different %s (%s, %s)' % (key, old['meta'].get(key), new['meta'].get(key)))
+
+    before = dict((r['id'], r) for r in old['results'])
+    regressions = []
+    print('%-60s %14s %14s %9s' % ('benchmark', 'before', 'after', 'change'))
+    for r in new['results']:
+        if r['id'] not in before:
+            continue
+        a = before[r['id']]['value']
+        b = r['value']
+
+        # express every change so that positive is better
+        if r['unit'] == 's':
+            change = (a - b) / b * 100 if b else 0.0
+        else:
+            change = (b - a) / a * 100 if a else 0.0
+        flag = ''
+        if change < -threshold:
+            regressions.append(r['id'])
+            flag = ' REGRESSION'
+        print('%-60s %14.6g %14.6g %+8.1f%%%s' % (r['id'], a, b, change, flag))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='destructor benchmark suite')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument('-o', '--output', help='write results to this JSON file')
+    run.add_argument('-k', '--filter', help='only run benchmarks whose id contains this string')
+    run.add_argument('-q', '--quick', action='store_true', help='fewer iterations, for a smoke test')
+    cmp = commands.add_parser('compare', help='compare two sets of results')
+    cmp.add_argument('before')
+    cmp.add_argument('after')
+    cmp.add_argument('-t', '--threshold', type=float, default=10.0,
+                     help='percentage slowdown reported as a regression (default 10)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        suite = Suite(quick=args.quick, pattern=args.filter)
+        suite.run()
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'meta': metadata(), 'results': suite.results}, f, indent=2, sort_keys=True)
+        return 0
+    elif args.command == 'compare':
+        with open(args.before) as f:
+            old = json.load(f)
+        with open(args.after) as f:
+            new = json.load(f)
+        regressions = compare(old, new, args.threshold)
+        if regressions:
+            print('%d regression(s) over %.1f%%' % (len(regressions), args.threshold))
+            return 1
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Benchmark layout construction against header size.
+
+Generates headers with a growing number of typedefs (in chains, the way vendor
+headers layer them) and structs whose members use them, then times resolving
+every struct layout. Construction should scale linearly, so the time per
+typedef should stay roughly flat as the header grows.
+
+    python benchmarks/typedefs.py [sizes...]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from destructor import *
+
+BASE_TYPES = ['unsigned char', 'short', 'unsigned int', 'long', 'unsigned long long', 'double']
+
+# number of typedefs in each chain, and members in each struct
+CHAIN = 4
+MEMBERS = 8
+
+
+def header(n):
+    """
+    Return C source with `n` typedefs and a struct for every chain of them.
+    """
+    lines = []
+    for i in range(0, n, CHAIN):
+        lines.append('typedef %s t%d;' % (BASE_TYPES[i // CHAIN % len(BASE_TYPES)], i))
+        for j in range(i + 1, min(i + CHAIN, n)):
+            lines.append('typedef t%d t%d;' % (j - 1, j))
+    for i in range(0, n, CHAIN):
+        last = min(i + CHAIN, n) - 1
+        members = ['    t%d m%d;' % (last, k) for k in range(MEMBERS)]
+        lines.append('struct s%d {\n%s\n};' % (i, '\n'.join(members)))
+    return '\n'.join(lines)
+
+
+def run(n):
+    ss = StructureSet(header(n))
+    start = time.time()
+    for i in range(len(ss.names)):
+        ss.layout(i)
+    return time.time() - start
+
+
+def main(sizes):
+    print('%10s %10s %14s' % ('typedefs', 'seconds', 'us/typedef'))
+    for n in sizes:
+        t = run(n)
+        print('%10d %10.4f %14.2f' % (n, t, t / n * 1e6))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [250, 500, 1000, 2000, 4000])
@@ -1 +1,5 @@
-from .structure import *
\ No newline at end of file
+from .structure import *
+from .cache import *
+from .header import *
+from .profiler import *
+from .predicates import *
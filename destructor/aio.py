@@ -0,0 +1,63 @@
+"""
+asyncio support, for Python 3.6 and later. These are exposed as the
+aiter_records() and awrite_many() methods of Structure.
+"""
+
+__all__ = ['aiter_records', 'awrite_many']
+
+
+async def aiter_records(cls, layout, reader, batch=1 << 16, lazy=False, view=False):
+    """
+    Read back-to-back records from an asyncio StreamReader in reads of up to
+    `batch` bytes, and yield a parsed instance for each one. Records that
+    span reads are carried over to the next read. If `lazy` is set the
+    records are parsed lazily, and if `view` is set they are views on a copy
+    of the data they were read in, so they can be changed but the changes
+    aren't sent back.
+    """
+    # imported here since structure imports this module
+    from .structure import _Chunker, _chunk_records
+
+    chunker = _Chunker(layout.size, batch)
+    while True:
+        data = await reader.read(chunker.wanted)
+        if not data:
+            break
+        data, count = chunker.feed(data)
+        for obj in _chunk_records(cls, layout, data, count, lazy, view):
+            yield obj
+    chunker.close()
+
+
+async def awrite_many(cls, layout, writer, records, batch=1 << 16):
+    """
+    Write a sequence (or an iterable or async iterable) of records
+    back-to-back to an asyncio StreamWriter. Records are packed into buffers
+    of about `batch` bytes, and the writer is drained after each one so a
+    slow reader applies back pressure.
+    """
+    size = layout.size
+    per = max(batch // size, 1)
+    buf = bytearray(per * size)
+    if not hasattr(records, '__aiter__'):
+        records = _aiter(records)
+
+    i = n = 0
+    async for rec in records:
+        if rec.size != size:
+            raise ValueError("Record %d is %d bytes, expected %d" % (i, rec.size, size))
+        rec.pack_into(buf, n * size)
+        i += 1
+        n += 1
+        if n == per:
+            writer.write(bytes(buf))
+            await writer.drain()
+            n = 0
+    if n:
+        writer.write(bytes(buf[:n * size]))
+        await writer.drain()
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
@@ -0,0 +1,98 @@
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+__all__ = ['LayoutCache']
+
+# bump this if the serialised layout format or the way a declaration is resolved changes
+# 2: arrays of structs, unions
+CACHE_VERSION = 2
+
+
+class LayoutCache(object):
+    """
+    A directory of resolved structure layouts. Each entry holds the layouts
+    for every struct in a piece of C source, and is keyed by a hash of the
+    source text along with the mode and endianness they were resolved for.
+
+    The cache keeps some counters so the startup time it saves can be
+    measured, see `stats`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.load_time = 0.0
+        self.resolve_time = 0.0
+        self.saved_time = 0.0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, source, mode, endian):
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8')
+        h = hashlib.sha1(source)
+        h.update(('\0%s\0%s\0%d\0%d.%d' % (mode, endian, CACHE_VERSION, sys.version_info[0],
+                                           sys.version_info[1])).encode('ascii'))
+        return h.hexdigest()
+
+    def filename(self, source, mode, endian):
+        return os.path.join(self.path, self.key(source, mode, endian) + '.layout')
+
+    def load(self, source, mode, endian):
+        """
+        Return the serialised layouts stored for this source, mode and
+        endianness, or None if there is no entry.
+        """
+        try:
+            with open(self.filename(source, mode, endian), 'rb') as f:
+                resolve_time, layouts = marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.saved_time += resolve_time
+        return layouts
+
+    def store(self, source, mode, endian, layouts, resolve_time=0.0):
+        """
+        Store serialised layouts for this source, mode and endianness, along
+        with the time it took to resolve them.
+        """
+        self.resolve_time += resolve_time
+
+        # write to a temporary file and rename it so concurrent readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(marshal.dumps((resolve_time, layouts)))
+        filename = self.filename(source, mode, endian)
+        try:
+            os.rename(tmp, filename)
+        except OSError:
+            os.remove(tmp)
+
+    def record_load(self, seconds):
+        self.load_time += seconds
+        self.saved_time -= seconds
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.layout'):
+                os.remove(os.path.join(self.path, name))
+
+    @property
+    def stats(self):
+        """
+        Counters for this cache. `saved_time` is the time it originally took
+        to parse and resolve every entry that was loaded, less the time it
+        took to load them.
+        """
+        return {
+            'hits':         self.hits,
+            'misses':       self.misses,
+            'load_time':    self.load_time,
+            'resolve_time': self.resolve_time,
+            'saved_time':   self.saved_time,
+        }
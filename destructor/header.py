@@ -0,0 +1,187 @@
+import bisect
+import re
+
+__all__ = ['HeaderIndex']
+
+# tokens we care about. comments, preprocessor lines, literals and numbers are skipped
+_tokens = re.compile(r'''
+    (?P<skip>\s+|/\*.*?\*/|//[^\n]*|^[ \t]*\#[^\n]*|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|[0-9][\w.]*)
+  | (?P<ident>[A-Za-z_]\w*)
+  | (?P<punct>.)
+''', re.M | re.S | re.X)
+
+TAGS = ('struct', 'union', 'enum')
+
+KEYWORDS = set([
+    'auto', 'break', 'case', 'char', 'const', 'continue', 'default', 'do', 'double', 'else', 'enum', 'extern', 'float',
+    'for', 'goto', 'if', 'inline', 'int', 'long', 'register', 'restrict', 'return', 'short', 'signed', 'sizeof',
+    'static', 'struct', 'switch', 'typedef', 'union', 'unsigned', 'void', 'volatile', 'while', '_Bool', '_Complex',
+    '__attribute__', '__extension__', '__inline', '__inline__', '__restrict', '__restrict__', '__const', '__volatile__',
+    '__asm__', '__asm',
+])
+
+
+class HeaderIndex(object):
+    """
+    An index of the top-level declarations in a piece of preprocessed C
+    source, built by scanning its tokens instead of parsing it.
+
+    The index records which declaration defines each typedef name, enum
+    constant and struct, union or enum tag, and where each struct appears, so
+    the source for a single struct and everything it depends on can be pulled
+    out and parsed on its own.
+    """
+    def __init__(self, source):
+        self.source = source
+
+        # (start, end) offsets of each top-level declaration
+        self.chunks = []
+
+        # the declaration that first defines each ('ident', name) or (tag keyword, name)
+        self.defs = {}
+
+        # (chunk, tag) for each top-level struct, in the order pycparser would find them
+        self.structs = []
+        self.struct_chunks = []
+
+        # the index in `structs` of the definition of each struct tag
+        self.struct_defs = {}
+
+        self._scan()
+
+    @property
+    def names(self):
+        return [tag for chunk, tag in self.structs]
+
+    def _scan(self):
+        # split the source into top-level declarations at semicolons and the end of function bodies
+        tokens = []
+        depth = 0
+        start = 0
+        body = False
+        for m in _tokens.finditer(self.source):
+            kind = m.lastgroup
+            if kind == 'skip':
+                continue
+            value = m.group()
+            tokens.append((kind, value))
+            if kind != 'punct':
+                continue
+            if value == '{':
+                if depth == 0:
+                    body = len(tokens) > 1 and tokens[-2][1] == ')'
+                depth += 1
+            elif value == '}':
+                depth -= 1
+            if depth == 0 and (value == ';' or value == '}' and body):
+                self._index_chunk(len(self.chunks), tokens)
+                self.chunks.append((start, m.end()))
+                start = m.end()
+                tokens = []
+                body = False
+
+    def _index_chunk(self, n, tokens):
+        # record what a declaration defines and the structs in it
+        typedef = False
+        depth = 0
+        enum_depth = None
+        for i, (kind, value) in enumerate(tokens):
+            prev = tokens[i - 1][1] if i else None
+            if kind == 'punct':
+                if value == '{':
+                    depth += 1
+                    if prev in TAGS:
+                        tag = None
+                    elif i > 1 and tokens[i - 2][1] in TAGS:
+                        tag = prev
+                        self.defs.setdefault((tokens[i - 2][1], tag), n)
+                    else:
+                        continue
+                    if tokens[i - 1 if tag is None else i - 2][1] == 'enum':
+                        enum_depth = depth
+                elif value == '}':
+                    if depth == enum_depth:
+                        enum_depth = None
+                    depth -= 1
+            elif value in TAGS:
+                if value == 'struct' and depth == 0:
+                    tag = tokens[i + 1][1] if i + 1 < len(tokens) and tokens[i + 1][0] == 'ident' else None
+                    if tag is not None and i + 2 < len(tokens) and tokens[i + 2][1] == '{':
+                        self.struct_defs.setdefault(tag, len(self.structs))
+                    self.structs.append((n, tag))
+                    self.struct_chunks.append(n)
+            elif value == 'typedef' and depth == 0:
+                typedef = True
+            elif prev in TAGS or value in KEYWORDS:
+                continue
+            elif depth == enum_depth and prev in ('{', ','):
+                self.defs.setdefault(('ident', value), n)
+            elif typedef and depth == 0:
+                self.defs.setdefault(('ident', value), n)
+
+    def refs(self, chunk):
+        """
+        Return the set of names used by a declaration.
+        """
+        start, end = self.chunks[chunk]
+        refs = set()
+        prev = None
+        for m in _tokens.finditer(self.source, start, end):
+            kind = m.lastgroup
+            if kind == 'skip':
+                continue
+            value = m.group()
+            if kind == 'ident':
+                if prev in TAGS:
+                    refs.add((prev, value))
+                elif value not in KEYWORDS:
+                    refs.add(('ident', value))
+            prev = value
+        return refs
+
+    def closure(self, chunk):
+        """
+        Return a sorted tuple of the declarations needed to parse `chunk`: the
+        declaration itself and every declaration it depends on, recursively.
+        """
+        seen = set([chunk])
+        todo = [chunk]
+        while todo:
+            for key in self.refs(todo.pop()):
+                c = self.defs.get(key)
+                if c is not None and c not in seen:
+                    seen.add(c)
+                    todo.append(c)
+        return tuple(sorted(seen))
+
+    def definition(self, index):
+        """
+        Return the index in `structs` of the definition of the struct at
+        `index`, or `index` itself if it's anonymous or never defined.
+        """
+        tag = self.structs[index][1]
+        if tag is None:
+            return index
+        return self.struct_defs.get(tag, index)
+
+    def subset(self, index):
+        """
+        Return (chunks, position) for the struct at `index`, where `chunks` is
+        its closure and `position` is the index of the struct among the
+        structs in the closure.
+        """
+        chunks = self.closure(self.structs[index][0])
+        position = 0
+        for c in chunks:
+            first = bisect.bisect_left(self.struct_chunks, c)
+            if c < self.structs[index][0]:
+                position += bisect.bisect_right(self.struct_chunks, c) - first
+            elif c == self.structs[index][0]:
+                position += index - first
+        return chunks, position
+
+    def text(self, chunks):
+        """
+        Return the source of a set of declarations.
+        """
+        return '\n'.join(self.source[self.chunks[c][0]:self.chunks[c][1]] for c in chunks)
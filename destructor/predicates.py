@@ -0,0 +1,102 @@
+"""
+Predicates on the values of struct members, for Structure.filter(). Each
+predicate can be compiled into a Python expression that's evaluated on
+values as they're unpacked, or evaluated on a numpy array of values.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['Predicate', 'Equal', 'Range', 'BitMask', 'OneOf']
+
+
+class Predicate(object):
+    """
+    A test on the value of a single member.
+    """
+    def expr(self, value, const):
+        """
+        Return the source of a Python expression that's true when the value
+        of the expression `value` passes the test. `const` takes a value and
+        returns the name it can be referred to by in the expression.
+        """
+        raise NotImplementedError
+
+    def mask(self, column):
+        """
+        Return a numpy boolean array that's true for each value in the numpy
+        array `column` that passes the test.
+        """
+        raise NotImplementedError
+
+
+class Equal(Predicate):
+    """
+    The value equals `value`.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def expr(self, value, const):
+        return '%s == %s' % (value, const(self.value))
+
+    def mask(self, column):
+        return column == self.value
+
+
+class Range(Predicate):
+    """
+    The value is at least `low` and less than `high`. Either can be None to
+    leave that end of the range open.
+    """
+    def __init__(self, low=None, high=None):
+        self.low = low
+        self.high = high
+
+    def expr(self, value, const):
+        if self.low is None and self.high is None:
+            return 'True'
+        elif self.low is None:
+            return '%s < %s' % (value, const(self.high))
+        elif self.high is None:
+            return '%s <= %s' % (const(self.low), value)
+        return '%s <= %s < %s' % (const(self.low), value, const(self.high))
+
+    def mask(self, column):
+        mask = numpy.ones(len(column), dtype=bool)
+        if self.low is not None:
+            mask &= column >= self.low
+        if self.high is not None:
+            mask &= column < self.high
+        return mask
+
+
+class BitMask(Predicate):
+    """
+    The bits of the value that are set in `mask` equal `value`, which
+    defaults to `mask` (i.e. all of those bits are set).
+    """
+    def __init__(self, mask, value=None):
+        self.bits = mask
+        self.value = mask if value is None else value
+
+    def expr(self, value, const):
+        return '%s & %s == %s' % (value, const(self.bits), const(self.value))
+
+    def mask(self, column):
+        return (column & self.bits) == self.value
+
+
+class OneOf(Predicate):
+    """
+    The value is one of `values`.
+    """
+    def __init__(self, values):
+        self.values = frozenset(values)
+
+    def expr(self, value, const):
+        return '%s in %s' % (value, const(self.values))
+
+    def mask(self, column):
+        return numpy.isin(column, list(self.values))
@@ -0,0 +1,339 @@
+"""
+Optional profiling counters. When profiling is enabled, the methods of
+Structure, StructureLayout and StructureSet that parse C, resolve layouts,
+decode, encode and do I/O are replaced with instrumented versions, and
+the originals are put back when it's disabled, so there is no overhead at
+all while it's off.
+
+For each Structure class the counters are:
+
+    parses      structures decoded by parse(), parse_many() and iter_records(),
+                and the matches built by filter()
+    packs       structures encoded by packed and pack_into(), including
+                those packed by write() and write_many()
+    reads       records read by read() and iter_records()
+    writes      records written by write() and write_many()
+    scans       records that only some members were decoded from, by scan(),
+                scan_columns() and peek()
+    bytes       bytes decoded plus bytes encoded, counting the whole of each
+                scanned record and just the member for peek()
+    time        cumulative seconds spent in parse, pack, read, write and scan.
+                these are inclusive, so read time includes the time spent
+                parsing, and scan time includes the time filter() spends
+                parsing its matches
+
+And for the whole process, the number of calls and cumulative seconds spent
+in each phase of building layouts:
+
+    parse_source    parsing C source with pycparser (StructureSet)
+    parse_decl      resolving struct declarations into layouts
+"""
+import collections
+import copy
+import time
+
+from .structure import Structure, StructureLayout, StructureSet, layoutmethod
+
+__all__ = ['enable_profiling', 'disable_profiling', 'profiling_enabled', 'reset_profiling', 'profile_snapshot']
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+# counters by class, or by layout for instances of Structure itself, such as
+# nested structs, so that classes which share a name are counted separately
+_classes = collections.OrderedDict()
+_phases = {}
+_originals = {}
+
+# nesting depth of parse_decl calls, so nested structs aren't timed twice
+_depth = [0]
+
+
+def _counters(cls, layout):
+    key = layout if cls is Structure else cls
+    try:
+        return _classes[key]
+    except KeyError:
+        c = _classes[key] = {'parses': 0, 'packs': 0, 'reads': 0, 'writes': 0, 'scans': 0, 'bytes': 0,
+                             'time': {'parse': 0.0, 'pack': 0.0, 'read': 0.0, 'write': 0.0, 'scan': 0.0}}
+        return c
+
+
+def _phase(name):
+    try:
+        return _phases[name]
+    except KeyError:
+        p = _phases[name] = {'count': 0, 'time': 0.0}
+        return p
+
+
+def _parse(func):
+    def parse(self, data, offset=0, lazy=False):
+        start = _timer()
+        try:
+            return func(self, data, offset, lazy)
+        finally:
+            c = _counters(type(self), self._layout)
+            c['time']['parse'] += _timer() - start
+            c['parses'] += 1
+            c['bytes'] += self.size
+    return parse
+
+
+def _packed(func):
+    def packed(self):
+        start = _timer()
+        try:
+            return func(self)
+        finally:
+            c = _counters(type(self), self._layout)
+            c['time']['pack'] += _timer() - start
+            c['packs'] += 1
+            c['bytes'] += self.size
+    return property(packed)
+
+
+def _pack_into(func):
+    def pack_into(self, buffer, offset=0):
+        start = _timer()
+        try:
+            return func(self, buffer, offset)
+        finally:
+            c = _counters(type(self), self._layout)
+            c['time']['pack'] += _timer() - start
+            c['packs'] += 1
+            c['bytes'] += self.size
+    return pack_into
+
+
+def _read(func):
+    def read(self, infile, offset=0):
+        start = _timer()
+        try:
+            return func(self, infile, offset)
+        finally:
+            c = _counters(type(self), self._layout)
+            c['time']['read'] += _timer() - start
+            c['reads'] += 1
+    return read
+
+
+def _write(func):
+    def write(self, outfile, offset=0):
+        start = _timer()
+        try:
+            return func(self, outfile, offset)
+        finally:
+            c = _counters(type(self), self._layout)
+            c['time']['write'] += _timer() - start
+            c['writes'] += 1
+    return write
+
+
+def _parse_many(func):
+    def parse_many(cls, layout, buffer, count=None, offset=0):
+        start = _timer()
+        n = 0
+        try:
+            columns = func(cls, layout, buffer, count, offset)
+            n = len(next(iter(columns.values()))) if columns else 0
+            return columns
+        finally:
+            c = _counters(cls, layout)
+            c['time']['parse'] += _timer() - start
+            c['parses'] += n
+            c['bytes'] += n * layout.size
+    return layoutmethod(parse_many)
+
+
+def _iter_records(func):
+    def iter_records(cls, layout, fileobj, chunk_size=1 << 20, lazy=False, view=False):
+        records = func(cls, layout, fileobj, chunk_size, lazy, view)
+        c = _counters(cls, layout)
+        while True:
+            start = _timer()
+            try:
+                obj = next(records)
+            except StopIteration:
+                c['time']['read'] += _timer() - start
+                return
+            c['time']['read'] += _timer() - start
+            c['reads'] += 1
+
+            # lazily parsed records are counted by parse(), and views aren't decoded
+            if not lazy and not view:
+                c['parses'] += 1
+                c['bytes'] += layout.size
+            yield obj
+    return layoutmethod(iter_records)
+
+
+def _write_many(func):
+    def write_many(cls, layout, outfile, records, offset=None):
+        if not hasattr(records, '__len__'):
+            records = list(records)
+        start = _timer()
+        try:
+            return func(cls, layout, outfile, records, offset)
+        finally:
+            c = _counters(cls, layout)
+            c['time']['write'] += _timer() - start
+            c['writes'] += len(records)
+    return layoutmethod(write_many)
+
+
+def _scanned(cls, layout, rows, count):
+    # time each row of a generator, counting them as scans if `count` is set
+    c = _counters(cls, layout)
+    while True:
+        start = _timer()
+        try:
+            row = next(rows)
+        except StopIteration:
+            c['time']['scan'] += _timer() - start
+            return
+        c['time']['scan'] += _timer() - start
+        if count:
+            c['scans'] += 1
+            c['bytes'] += layout.size
+        yield row
+
+
+def _scan(func):
+    def scan(cls, layout, source, fields, count=None, offset=0, chunk_size=1 << 20):
+        return _scanned(cls, layout, iter(func(cls, layout, source, fields, count, offset, chunk_size)), True)
+    return layoutmethod(scan)
+
+
+def _scan_columns(func):
+    def scan_columns(cls, layout, source, fields, count=None, offset=0, chunk_size=1 << 20, batch=65536):
+        start = _timer()
+        n = 0
+        try:
+            columns = func(cls, layout, source, fields, count, offset, chunk_size, batch)
+            n = len(next(iter(columns.values()))) if columns else 0
+            return columns
+        finally:
+            c = _counters(cls, layout)
+            c['time']['scan'] += _timer() - start
+            c['scans'] += n
+            c['bytes'] += n * layout.size
+    return layoutmethod(scan_columns)
+
+
+def _filter(func):
+    def filter(cls, layout, source, where, count=None, offset=0, chunk_size=1 << 20, vectorize=None):
+        # the matches are counted as they're parsed
+        return _scanned(cls, layout, func(cls, layout, source, where, count, offset, chunk_size, vectorize), False)
+    return layoutmethod(filter)
+
+
+def _peek(func):
+    def peek(cls, layout, buffer, path, offset=0):
+        start = _timer()
+        size = None
+        try:
+            value = func(cls, layout, buffer, path, offset)
+            size = layout.field(path)[1].size
+            return value
+        finally:
+            c = _counters(cls, layout)
+            c['time']['scan'] += _timer() - start
+            if size is not None:
+                c['scans'] += 1
+                c['bytes'] += size
+    return layoutmethod(peek)
+
+
+def _timed(name, func):
+    def timed(*args, **kwargs):
+        _depth[0] += 1
+        start = _timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _depth[0] -= 1
+            p = _phase(name)
+            p['count'] += 1
+            if not _depth[0]:
+                p['time'] += _timer() - start
+    timed.__name__ = func.__name__
+    return timed
+
+
+def _instrumented():
+    # (class, attribute, instrumented version) for everything we replace
+    d = Structure.__dict__
+    return [
+        (Structure, 'parse', _parse(d['parse'])),
+        (Structure, 'packed', _packed(d['packed'].fget)),
+        (Structure, 'pack_into', _pack_into(d['pack_into'])),
+        (Structure, 'read', _read(d['read'])),
+        (Structure, 'write', _write(d['write'])),
+        (Structure, 'parse_many', _parse_many(d['parse_many'].func)),
+        (Structure, 'iter_records', _iter_records(d['iter_records'].func)),
+        (Structure, 'write_many', _write_many(d['write_many'].func)),
+        (Structure, 'scan', _scan(d['scan'].func)),
+        (Structure, 'scan_columns', _scan_columns(d['scan_columns'].func)),
+        (Structure, 'filter', _filter(d['filter'].func)),
+        (Structure, 'peek', _peek(d['peek'].func)),
+        (StructureSet, '_parse', _timed('parse_source', StructureSet.__dict__['_parse'])),
+        (StructureLayout, 'parse_decl', _timed('parse_decl', StructureLayout.__dict__['parse_decl'])),
+    ]
+
+
+def enable_profiling():
+    """
+    Start counting. Counters keep their values until reset_profiling().
+    """
+    if _originals:
+        return
+    for cls, name, method in _instrumented():
+        _originals[(cls, name)] = cls.__dict__[name]
+        setattr(cls, name, method)
+
+
+def disable_profiling():
+    """
+    Stop counting and restore the uninstrumented methods.
+    """
+    for (cls, name), method in _originals.items():
+        setattr(cls, name, method)
+    _originals.clear()
+
+
+def profiling_enabled():
+    return bool(_originals)
+
+
+def reset_profiling():
+    """
+    Zero all of the counters.
+    """
+    _classes.clear()
+    _phases.clear()
+
+
+def profile_snapshot():
+    """
+    Return a copy of the counters as a dict with 'classes', mapping each
+    Structure class name to its counters, and 'phases', mapping each phase to
+    its call count and time. Instances of Structure itself are named after
+    their layout, like 'struct Test', and when two classes share a name the
+    later ones get a '#2', '#3' and so on.
+    """
+    classes = {}
+    for key, c in _classes.items():
+        if isinstance(key, StructureLayout):
+            name = '%s %s' % ('union' if key.union else 'struct', key.name)
+        else:
+            name = key.__name__
+        unique, n = name, 1
+        while unique in classes:
+            n += 1
+            unique = '%s#%d' % (name, n)
+        classes[unique] = copy.deepcopy(c)
+    return {
+        'enabled':  profiling_enabled(),
+        'classes':  classes,
+        'phases':   copy.deepcopy(_phases),
+    }
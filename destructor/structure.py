@@ -1,24 +1,296 @@
+import array
+import itertools
+import linecache
+import marshal
+import mmap
+import multiprocessing
+import os
 import pycparser
+import re
 import struct
+import sys
+import time
 
 from pycparser import c_parser, c_ast
 
+from .cache import LayoutCache
+from .header import HeaderIndex
+from .predicates import Predicate, Equal
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = dict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+# asyncio support needs async generators
+if sys.version_info >= (3, 6):
+    from . import aio
+else:
+    aio = None
+
+__all__ = ['MODE_ILP32', 'MODE_LP64', 'MODE_ILP32_ALIGNED', 'MODE_LP64_ALIGNED', 'ENDIAN_LITTLE', 'ENDIAN_BIG',
+           'sizeof', 'offsetof', 'codec_for', 'iter_unpack', 'iter_chunks', 'find_node', 'GeneratedCode', 'layoutmethod',
+           'NodeFinder', 'NodeCollector', 'TypeResolver', 'StructureMember', 'MemberLayout', 'StructArrayLayout',
+           'StructureLayout', 'Structure', 'StructArray', 'MappedFile', 'StructureSet',
+           # exported by earlier releases, which had no __all__
+           'pycparser', 'c_parser', 'c_ast', 'struct']
+
 MODE_ILP32 = 'ILP32'
 MODE_LP64 = 'LP64'
 
+# the same data models with C alignment and padding, following the i386 and x86-64 System V ABIs. the plain modes
+# are packed
+MODE_ILP32_ALIGNED = 'ILP32-aligned'
+MODE_LP64_ALIGNED = 'LP64-aligned'
+
 ENDIAN_LITTLE = 'little'
 ENDIAN_BIG = 'big'
 
 
+_codecs = {}
+
+
 def sizeof(obj):
     return obj.size
 
 
+def offsetof(obj, path):
+    return obj.offsetof(path)
+
+
+def codec_for(fmt):
+    """
+    Return a struct.Struct for the given format string. Compiled formats are
+    cached so that every structure sharing a layout shares a codec.
+    """
+    try:
+        return _codecs[fmt]
+    except KeyError:
+        codec = _codecs[fmt] = struct.Struct(fmt)
+        return codec
+
+
+def iter_unpack(codec, buffer, offset=0, count=None):
+    """
+    Unpack `count` consecutive records with `codec`, starting at `offset`.
+    """
+    if count is None:
+        count = (len(buffer) - offset) // codec.size
+    if hasattr(codec, 'iter_unpack'):
+        return codec.iter_unpack(memoryview(buffer)[offset:offset + count * codec.size])
+    return (codec.unpack_from(buffer, o) for o in itertools.islice(itertools.count(offset, codec.size), count))
+
+
+class _Chunker(object):
+    """
+    Carries records that span reads over into the next read, for iter_chunks()
+    and aio.aiter_records(). Read up to `wanted` bytes, pass them to feed(),
+    and call close() at the end of the stream.
+    """
+    def __init__(self, record_size, chunk_size=1 << 20):
+        self.record_size = record_size
+        self.chunk_size = max(chunk_size - chunk_size % record_size, record_size)
+        self.pending = b''
+
+    @property
+    def wanted(self):
+        return self.chunk_size - len(self.pending)
+
+    def feed(self, data):
+        # return `data` after the pending bytes, and the number of whole records at the start of that
+        if self.pending:
+            data = self.pending + data
+        count = len(data) // self.record_size
+        self.pending = data[count * self.record_size:]
+        return data, count
+
+    def close(self):
+        if self.pending:
+            raise ValueError("Incomplete record at end of stream (%d of %d bytes)" % (len(self.pending),
+                                                                                      self.record_size))
+
+
+def iter_chunks(fileobj, record_size, chunk_size=1 << 20):
+    """
+    Read `fileobj` (a file-like object or a socket) in chunks of about
+    `chunk_size` bytes. Yields (data, count) tuples where `data` starts with
+    `count` whole records of `record_size` bytes. Records that span chunk
+    boundaries are carried over into the next chunk.
+    """
+    read = getattr(fileobj, 'read', None) or fileobj.recv
+    chunker = _Chunker(record_size, chunk_size)
+    while True:
+        data = read(chunker.wanted)
+        if not data:
+            break
+        data, count = chunker.feed(data)
+        if count:
+            yield data, count
+    chunker.close()
+
+
+def _chunk_records(cls, layout, data, count, lazy=False, view=False):
+    # yield an instance of `cls` for each of the `count` records at the start of a chunk read by iter_records() or
+    # aiter_records(). views get a writable copy of the records, since the chunk may be immutable
+    size = layout.size
+    if view:
+        data = bytearray(memoryview(data)[:count * size])
+    if lazy or view:
+        for offset in range(0, count * size, size):
+            obj = cls.from_layout(layout)
+            if view:
+                obj.bind(data, offset)
+            else:
+                obj.parse(data, offset, lazy=True)
+            yield obj
+    else:
+        load = layout.code.load
+        for values in iter_unpack(layout.codec, data, 0, count):
+            obj = cls.from_layout(layout)
+            load(obj, values)
+            yield obj
+
+
+def _record_chunks(source, size, count=None, offset=0, chunk_size=1 << 20):
+    # return an iterator of (data, offset, count) for runs of about `chunk_size` bytes of back-to-back records, taken
+    # from `count` records (or all of them) in a buffer, mmap or MappedFile starting at `offset`, or read from a
+    # file-like object or socket
+    if isinstance(source, MappedFile):
+        source = source.map
+    per = max(chunk_size // size, 1)
+    if isinstance(source, mmap.mmap) or not (hasattr(source, 'read') or hasattr(source, 'recv')):
+        available = (len(source) - offset) // size
+        if count is None:
+            count = available
+        elif count > available:
+            raise ValueError("Buffer holds %d records, %d requested" % (available, count))
+        return ((source, offset + i * size, min(per, count - i)) for i in range(0, count, per))
+
+    if offset:
+        source.seek(offset)
+
+    def chunks(count):
+        for data, n in iter_chunks(source, size, chunk_size):
+            if count is not None:
+                n = min(n, count)
+                count -= n
+            yield data, 0, n
+            if count == 0:
+                return
+    return chunks(count)
+
+
+def _scan_rows(codec, source, count=None, offset=0, chunk_size=1 << 20):
+    # unpack `count` back-to-back records (or all of them) from a source with `codec`
+    return itertools.chain.from_iterable(iter_unpack(codec, data, o, n)
+                                         for data, o, n in _record_chunks(source, codec.size, count, offset, chunk_size))
+
+
+def _dump_values(obj):
+    # the values of a structure as a list, for structures the generated code can't handle
+    values = []
+    obj._dump(values)
+    return values
+
+
+class GeneratedCode(object):
+    """
+    The functions generated for a StructureLayout, and their source.
+    """
+
+
+# numbers the filenames of generated code so linecache entries don't collide
+_generated = itertools.count()
+
+
+# layouts deserialized by worker processes, keyed by their serialized form
+_worker_layouts = {}
+
+
+def _parse_range(data, mode, endian, filename, offset, count, reduce=None):
+    # parse a range of records in a worker process. the worker maps the file itself so the records don't need to be
+    # pickled and sent to it
+    key = (marshal.dumps(data), mode, endian)
+    try:
+        layout = _worker_layouts[key]
+    except KeyError:
+        layout = _worker_layouts[key] = StructureLayout.deserialize(data, mode, endian)
+
+    with open(filename, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            columns = layout.parse_many(m, count, offset)
+        finally:
+            m.close()
+
+    if reduce is not None:
+        return reduce(columns)
+
+    # pickling the columns is slow (especially on python 2), so send back a marshalled blob with the raw values of
+    # the array columns instead
+    return marshal.dumps([(path, c.typecode, _array_bytes(c)) if isinstance(c, array.array) else (path, None, c)
+                          for path, c in columns.items()])
+
+
+def _array_bytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def _compile_header(source, filename, mode, endian):
+    # parse and resolve every struct in a header in a worker process, returning the source and serialized layouts
+    start = time.time()
+    ss = StructureSet(source=source, filename=filename, mode=mode, endian=endian)
+    return ss.source, ss.resolve_all(mode, endian)[1], time.time() - start
+
+
+def _declaration(ss, ref):
+    # find the declaration of the struct or union that `ref` refers to in the StructureSet `ss`
+    decl = ss.decl_named(ref.name, type(ref))
+    if decl is None:
+        raise NameError("No declaration was found for %s %s" % (type(ref).__name__.lower(), ref.name))
+    return decl
+
+
+class layoutmethod(object):
+    """
+    A method that operates on a StructureLayout. When called on an instance it
+    uses the instance's layout, and when called on a class it uses the class's
+    layout for the `mode` and `endian` keyword arguments.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        func = self.func
+        if obj is not None:
+            layout = obj._layout
+            def method(*args, **kwargs):
+                return func(cls, layout, *args, **kwargs)
+        else:
+            def method(*args, **kwargs):
+                layout = cls.layout_for(kwargs.pop('mode', MODE_LP64), kwargs.pop('endian', ENDIAN_LITTLE))
+                return func(cls, layout, *args, **kwargs)
+        method.__name__ = func.__name__
+        method.__doc__ = func.__doc__
+        return method
+
+
 class NodeFinder(object):
     nodes = []
 
-    def __init__(self, cls):
-        self.col = NodeCollector(cls)
+    def __init__(self, cls, skip=()):
+        self.col = NodeCollector(cls, skip)
 
     def find(self, node):
         self.col.visit(node)
@@ -27,13 +299,19 @@ class NodeFinder(object):
 
 class NodeCollector(c_ast.NodeVisitor):
     """
-    A NodeVisitor subclass used to collect instances of a specific node class
+    A NodeVisitor subclass used to collect instances of a specific node class,
+    without looking inside nodes of the classes in `skip`
     """
     cls = None
 
-    def __init__(self, cls):
+    def __init__(self, cls, skip=()):
         self.nodes = []
         self.cls = cls
+        self.skip = skip
+
+    def generic_visit(self, node):
+        if type(node) not in self.skip:
+            c_ast.NodeVisitor.generic_visit(self, node)
 
     def visit_collect(self, node):
         if type(node) is self.cls:
@@ -46,9 +324,29 @@ class NodeCollector(c_ast.NodeVisitor):
             return object.__getattribute__(self, name)
 
 
+def find_node(node, cls):
+    """
+    Return the first node of class `cls` (or of one of a tuple of classes)
+    found in a depth-first search from `node` (including `node` itself), or
+    None. This finds the same node as NodeFinder(cls).find(node)[0] without
+    visiting the rest of the tree.
+    """
+    if isinstance(node, cls):
+        return node
+    for name, child in node.children():
+        found = find_node(child, cls)
+        if found is not None:
+            return found
+    return None
+
+
 class TypeResolver(object):
     """
     A utility class to resolve typedefs and get some other type info from the AST
+
+    Typedefs are indexed by name when the resolver is created, and each name is
+    resolved to its base type once, so resolving types doesn't depend on the
+    number of typedefs in the source.
     """
 
     base_types = ['char', '_Bool', 'int', 'long', 'long long', 'float', 'double', 'long double']
@@ -56,46 +354,78 @@ class TypeResolver(object):
     def __init__(self, ast):
         self.typedefs = NodeFinder(pycparser.c_ast.Typedef).find(ast)
 
-    def resolve_type(self, thetype):
+        # index the typedefs by name, the first declaration of a name wins
+        self.typedef_names = {}
+        for t in self.typedefs:
+            self.typedef_names.setdefault(t.name, t)
+
+        # resolved types by typedef name, None if the name doesn't resolve
+        self.resolved = {}
+
+    def identifier_type(self, thetype):
         # find the IdentifierType node
-        ident = NodeFinder(pycparser.c_ast.IdentifierType).find(thetype)[0]
+        ident = find_node(thetype, pycparser.c_ast.IdentifierType)
+        if ident is None:
+            raise IndexError("No identifier type found")
+        return ident
 
+    def resolve_type(self, thetype):
+        name = self.identifier_type(thetype).names[0]
         try:
-            # find a match
-            match = [t for t in self.typedefs if t.name == ident.names[0]][0]
-            match_ident = NodeFinder(pycparser.c_ast.IdentifierType).find(match)[0]
-
-            # if this resolves to a base type
-            if len([n for n in match_ident.names if n in self.base_types]):
-                # we're done
-                return match.type
-            else:
-                # otherwise keep going
-                return self.resolve_type(match)
-        except IndexError:
-            # didn't find a match, return the type we were given
-            return thetype
+            resolved = self.resolved[name]
+        except KeyError:
+            resolved = self.resolved[name] = self.resolve_name(name)
+
+        # if it didn't resolve, return the type we were given
+        return thetype if resolved is None else resolved
+
+    def resolve_name(self, name):
+        """
+        Follow the chain of typedefs for `name` to a base type. Returns the
+        resolved type node, or None if there's no typedef for `name`.
+        """
+        try:
+            return self.resolved[name]
+        except KeyError:
+            pass
+
+        # find a match
+        match = self.typedef_names.get(name)
+        if match is None:
+            return None
+        match_ident = find_node(match, pycparser.c_ast.IdentifierType)
+        if match_ident is None:
+            return None
+
+        if len([n for n in match_ident.names if n in self.base_types]):
+            # this resolves to a base type, we're done
+            resolved = match.type
+        else:
+            # otherwise keep going, stopping at this typedef if the chain is broken
+            resolved = self.resolve_name(match_ident.names[0])
+            if resolved is None:
+                resolved = match
+        self.resolved[name] = resolved
+        return resolved
 
     def name_for_type(self, thetype):
-        # find the IdentifierType node
-        ident = NodeFinder(pycparser.c_ast.IdentifierType).find(thetype)[0]
-
         # join the type name components
-        return ' '.join(ident.names)
+        return ' '.join(self.identifier_type(thetype).names)
 
     def find_struct_node(self, thetype):
-        try:
-            # find a Struct node
-            s = NodeFinder(pycparser.c_ast.Struct).find(thetype)[0]
-        except IndexError:
-            s = None
-        return s
+        # find a Struct or Union node
+        return find_node(thetype, (pycparser.c_ast.Struct, pycparser.c_ast.Union))
 
 
 class StructureMember(object):
     """
     A structure member variable. Keeps track of the size, format, etc for an
     individual struct member.
+
+    The layout of the member is kept in a MemberLayout. The members of a
+    Structure are lightweight accessors for a value stored by the structure,
+    and share their layout with every other instance of it. A StructureMember
+    created on its own holds its own value.
     """
     sizes = {
         'char':     1,
@@ -123,84 +453,131 @@ class StructureMember(object):
         'float':                'f',
         'double':               'd'
     }
+    # numpy type kinds for each struct format character, sizes come from the sizes above
+    dtype_kinds = {
+        '?':    'b',
+        'c':    'S',
+        's':    'S',
+        'b':    'i',
+        'B':    'u',
+        'h':    'i',
+        'H':    'u',
+        'i':    'i',
+        'I':    'u',
+        'l':    'i',
+        'L':    'u',
+        'q':    'i',
+        'Q':    'u',
+        'f':    'f',
+        'd':    'f'
+    }
 
-    _size = 0
-    _array_len = 1
-    _value = None
-    _endian = ENDIAN_LITTLE
+    __slots__ = ('_layout', '_owner', '_index', '_value', '_buffer', '_offset')
 
     def __init__(self, name=None, type_name=None, node=None, mode=MODE_LP64, array_len=1, endian=ENDIAN_LITTLE):
-        self._basic_type = type_name.replace('unsigned', '').replace('signed', '').strip()
-        self._full_type = type_name
-        self._array_len = array_len
-        self._endian = endian
-
-        if type_name in self.formats:
-            # sort out the basic types
-            self._size = self.sizes[self._basic_type]
-            self._format = self.formats[self._full_type]
-
-            # mode-specific sizes/formats
-            if type_name == 'unsigned long':
-                self._format = 'Q' if mode == MODE_LP64 else 'L'
-                self._size = 8 if mode == MODE_LP64 else 4
-            elif type_name == 'long':
-                self._format = 'q' if mode == MODE_LP64 else 'l'
-                self._size = 8 if mode == MODE_LP64 else 4
-
-            # if it's a character array, use the string formatter instead
-            if type_name == "char" and array_len > 1:
-                self._format = 's'
-        elif type_name.strip().endswith('*'):
-            # we use a quad/double word instead of pointers due to the endian
-            # stuff in the struct module (see the doco for details)
-            self._format = 'Q' if mode == MODE_LP64 else 'L'
-            self._size = 8 if mode == MODE_LP64 else 4
-        else:
-            raise Exception("Unknown type '%s'" % type_name)
+        self._layout = MemberLayout(type_name, mode, array_len, endian)
+        self._owner = None
+        self._index = 0
+        self._value = None
+        self._buffer = None
+        self._offset = 0
+
+    @classmethod
+    def accessor(cls, layout, owner, index):
+        """
+        Return a member that accesses the value at `index` in the Structure
+        `owner`.
+        """
+        member = cls.__new__(cls)
+        member._layout = layout
+        member._owner = owner
+        member._index = index
+        member._value = None
+        member._buffer = None
+        return member
 
     def __str__(self):
         return self.packed
 
     @property
     def size(self):
-        return self._size * self._array_len
+        return self._layout.size
 
     @property
     def format(self):
-        if self._array_len > 1:
-            a = str(self.array_len)
-        else:
-            a = ''
-        return self.endian_format + a + self._format
+        return self._layout.format
+
+    @property
+    def raw_format(self):
+        return self._layout.raw_format
+
+    @property
+    def dtype(self):
+        return self._layout.dtype
+
+    @property
+    def typecode(self):
+        return self._layout.typecode
+
+    @property
+    def count(self):
+        return self._layout.count
 
     @property
     def endian_format(self):
-        return '<' if self._endian == ENDIAN_LITTLE else '>'
+        return self._layout.endian_format
 
     @property
     def array_len(self):
-        return self._array_len
+        return self._layout.array_len
 
     @array_len.setter
     def array_len(self, value):
-        self._array_len = value
+        if self._owner is not None:
+            raise AttributeError("Can't change the array length of a member of a Structure")
+        l = self._layout
+        self._layout = MemberLayout(l.type_name, l.mode, value, l.endian)
 
     @property
     def value(self):
+        if self._owner is not None:
+            return self._owner._get(self._index)
+
+        # if we're bound to a buffer, it holds our value
+        if self._buffer is not None:
+            self._value = self._layout.decode(self._buffer, self._offset)
         return self._value
 
     @value.setter
     def value(self, value):
+        if self._owner is not None:
+            self._owner._set(self._index, value)
+            return
+
         self._value = value
+        if self._buffer is not None:
+            self._layout.pack_into(self._buffer, self._offset, value)
+
+    def bind(self, buffer, offset=0):
+        """
+        Bind this member to a writable buffer. Reading the value decodes it
+        from the buffer at `offset`, and setting it packs it straight into the
+        buffer. A member of a Structure is detached from it.
+        """
+        self._owner = None
+        self._buffer = buffer
+        self._offset = offset
+
+    def unbind(self):
+        """
+        Stop viewing a buffer, keeping a copy of the value it holds.
+        """
+        self.value
+        self._buffer = None
 
     @property
     def packed(self):
-        if type(self.value) == list:
-            data = struct.pack(self.format, *self.value)
-        else:
-            data = struct.pack(self.format, self.value)
-        return data
+        return self._layout.pack(self.value)
 
     def read(self, input):
         if type(input) == str:
@@ -210,208 +587,1946 @@ class StructureMember(object):
         self.parse(data)
 
     def parse(self, data, offset=0):
-        self.value = list(struct.unpack(self.format, data[offset:offset+self.size]))
-        if len(self.value) == 1:
-            self.value = self.value[0]
+        self.value = self._layout.decode(data, offset)
 
     def write(self, output):
         output.write(self.packed)
 
+    def pack_into(self, buffer, offset=0):
+        self._layout.pack_into(buffer, offset, self.value)
 
-class Structure(object):
+
+class MemberLayout(object):
     """
-    A structure. Initialise this with the source for a struct definition. If
-    multiple struct definitions are found the first one will be used.
+    The layout of a basic struct member: its type, size, format and codec.
+    Member layouts are immutable and shared by every instance of a structure.
     """
-    _members = {}
-    _endian = ENDIAN_LITTLE
+    __slots__ = ('type_name', 'mode', 'endian', 'array_len', 'char', 'item_size', 'size', 'align', 'count',
+                 'raw_format', 'format', 'codec')
+
+    def __init__(self, type_name, mode=MODE_LP64, array_len=1, endian=ENDIAN_LITTLE):
+        self.type_name = type_name
+        self.mode = mode
+        self.endian = endian
+        self.array_len = array_len
+        lp64 = mode in (MODE_LP64, MODE_LP64_ALIGNED)
+
+        basic_type = type_name.replace('unsigned', '').replace('signed', '').strip()
+        if type_name in StructureMember.formats:
+            # sort out the basic types
+            self.item_size = StructureMember.sizes[basic_type]
+            self.char = StructureMember.formats[type_name]
 
-    _source = None
-    _name = None
+            # mode-specific sizes/formats
+            if type_name == 'unsigned long':
+                self.char = 'Q' if lp64 else 'L'
+                self.item_size = 8 if lp64 else 4
+            elif type_name == 'long':
+                self.char = 'q' if lp64 else 'l'
+                self.item_size = 8 if lp64 else 4
 
-    def __init__(self, binary=None, source=None, filename=None, decl=None, ast=None, mode=MODE_LP64, endian=ENDIAN_LITTLE):
-        self._endian = endian
+            # if it's a character array, use the string formatter instead
+            if type_name == "char" and array_len > 1:
+                self.char = 's'
+        elif type_name.strip().endswith('*'):
+            # we use a quad/double word instead of pointers due to the endian
+            # stuff in the struct module (see the doco for details)
+            self.char = 'Q' if lp64 else 'L'
+            self.item_size = 8 if lp64 else 4
+        else:
+            raise Exception("Unknown type '%s'" % type_name)
 
-        # if we didn't have any source provided by our subclass, override it with what was passed to __init__()
-        if not self._source:
-            self._source = source
+        self.size = self.item_size * array_len
 
-        # parse source/file if we got some
-        if self._source or filename:
-            # create a structure set
-            self._ss = StructureSet(source=self._source, filename=filename)
-            ast = self._ss.ast
-
-            # find the structure by name if one was given
-            if self._name:
-                decl = self._ss.decl_named(self._name)
-                if not decl:
-                    raise NameError("No struct declaration was found named '%s'" % self.name)
-            else:
-                # otherwise grab the first struct
-                try:
-                    decl = self._ss.decls[0]
-                except IndexError:
-                    raise IndexError("No struct declaration was found")
-
-        # keep references to our ast and decl. check if we don't aready have them, as we may have if this came from
-        # a StructureSet
-        if not self._ast:
-            self._ast = ast
-        if not self._decl:
-            self._decl = decl
-        if not self._name:
-            self._name = self._decl.name
+        # in aligned modes members are aligned to the size of their type, except that i386 aligns 8 byte types to 4
+        if mode in (MODE_ILP32_ALIGNED, MODE_LP64_ALIGNED):
+            self.align = min(self.item_size, 8 if lp64 else 4)
+        else:
+            self.align = 1
 
-        # find any typedefs we might need
-        self._tr = TypeResolver(self._ast)
+        # number of values this member unpacks to (strings unpack to a single value)
+        self.count = 1 if self.char == 's' else array_len
 
-        # parse the declarator for our member info
-        self.parse_decl(self._decl, mode)
+        self.raw_format = (str(array_len) if array_len > 1 else '') + self.char
+        self.format = self.endian_format + self.raw_format
+        self.codec = codec_for(self.format)
 
-        # if we got a binary, parse it
-        if binary:
-            if type(binary) == str:
-                self.parse(binary)
-            else:
-                self.read(binary)
+    @property
+    def endian_format(self):
+        return '<' if self.endian == ENDIAN_LITTLE else '>'
 
-    def __str__(self):
-        return ''.join([str(m) for m in self._members_ord])
+    @property
+    def dtype(self):
+        # a numpy dtype field description for this member, char arrays are strings and other arrays are subarrays
+        kind = StructureMember.dtype_kinds[self.char]
+        if kind == 'S':
+            return ('|S%d' % self.size,)
+        elif kind == 'b':
+            t = '|b1'
+        else:
+            t = self.endian_format + kind + str(self.item_size)
+        if self.array_len > 1:
+            return (t, (self.array_len,))
+        return (t,)
+
+    @property
+    def typecode(self):
+        # the array module typecode that can hold our values, or None if they need to be kept in a list
+        if self.char in 'bBhHiIlLqQfd':
+            try:
+                if array.array(self.char).itemsize >= self.item_size:
+                    return self.char
+            except ValueError:
+                pass
+        return None
+
+    def decode(self, data, offset=0):
+        values = self.codec.unpack_from(data, offset)
+        if self.count == 1:
+            return values[0]
+        return list(values)
+
+    def pack(self, value):
+        if self.count == 1:
+            return self.codec.pack(value)
+        return self.codec.pack(*value)
+
+    def pack_into(self, buffer, offset, value):
+        if self.count == 1:
+            self.codec.pack_into(buffer, offset, value)
+        else:
+            self.codec.pack_into(buffer, offset, *value)
+
+
+class StructArrayLayout(object):
+    """
+    The layout of an array of structs: `array_len` back-to-back elements
+    with the StructureLayout `element`. The value of one of these members is
+    a StructArray.
+    """
+    __slots__ = ('element', 'mode', 'endian', 'array_len', 'type_name', 'size', 'align', 'count', 'raw_format', 'format')
+
+    def __init__(self, element, array_len):
+        self.element = element
+        self.mode = element.mode
+        self.endian = element.endian
+        self.array_len = array_len
+        self.type_name = '%s %s' % ('union' if element.union else 'struct', element.name)
+        self.size = element.size * array_len
+        self.align = element.align
+        self.count = element.count * array_len
+        self.raw_format = element.raw_format * array_len
+        self.format = element.endian_format + self.raw_format
+
+    def decode(self, data, offset=0):
+        # the elements are parsed from the data when they're accessed
+        return StructArray(self, buffer=data, offset=offset)
+
+    def decode_dict(self, data, offset=0):
+        # the elements as a list of dicts
+        e = self.element
+        return [e.decode_dict(data, offset + i * e.size) for i in range(self.array_len)]
+
+
+class StructureLayout(object):
+    """
+    The resolved layout of a struct declaration for a particular mode and
+    endianness. A layout is computed once and shared by every Structure
+    instance that uses it, so instances only need to allocate their values.
+
+    Unions have layouts too, with every member at offset 0. A union is
+    unpacked as a string of the bytes it holds, and a Structure for a union
+    is always a view on its bytes, so each member reads them in its own way.
+    """
+    def __init__(self, decl=None, tr=None, ss=None, mode=MODE_LP64, endian=ENDIAN_LITTLE, union=False):
+        self.decl = decl
+        self.name = decl.name if decl else None
+        self.mode = mode
+        self.endian = endian
+        self.union = union or type(decl) == pycparser.c_ast.Union
+        self.members = []
+        if decl:
+            self.parse_decl(decl, tr, ss)
 
     @property
     def size(self):
-        return sum([m.size for m in self._members_ord])
+        return self.codec.size
 
     @property
-    def endian(self):
-        return self._endian
+    def format(self):
+        return self.codec.format
 
-    def parse_decl(self, decl, mode=MODE_LP64):
-        self._mode = mode
-        self._members = {}
-        self._members_ord = []
+    @property
+    def endian_format(self):
+        return '<' if self.endian == ENDIAN_LITTLE else '>'
+
+    @property
+    def count(self):
+        if self.union:
+            return 1
+        return sum([m.count for n, m in self.members])
+
+    def decode_dict(self, data, offset=0):
+        # the values at `offset` in `data` as a dict
+        return self.code.to_dict(self.codec.unpack_from(data, offset))
+
+    def flatten(self, prefix='', index=0, offset=0):
+        """
+        Return a list of (path, member, index, offset) tuples for every basic
+        member in this layout. Members of nested structs are given dotted
+        paths, `index` is the position of the member's first value in the
+        tuple unpacked by the codec and `offset` is its offset in bytes.
+        """
+        fields = []
+        for i, (name, m) in enumerate(self.members):
+            if type(m) == StructureLayout and m.union:
+                # unions are just their bytes
+                fields.append((prefix + name, MemberLayout('char', self.mode, m.size, self.endian), index,
+                               offset + self.offset_list[i]))
+            elif type(m) == StructureLayout:
+                fields.extend(m.flatten(prefix + name + '.', index, offset + self.offset_list[i]))
+            elif type(m) == StructArrayLayout:
+                e = m.element
+                for j in range(m.array_len):
+                    if e.union:
+                        fields.append(('%s%s[%d]' % (prefix, name, j), MemberLayout('char', self.mode, e.size,
+                                       self.endian), index + j, offset + self.offset_list[i] + j * e.size))
+                    else:
+                        fields.extend(e.flatten('%s%s[%d].' % (prefix, name, j), index + j * e.count,
+                                                offset + self.offset_list[i] + j * e.size))
+            else:
+                fields.append((prefix + name, m, index, offset + self.offset_list[i]))
+            index += m.count
+        return fields
+
+    @property
+    def paths(self):
+        """
+        A dict mapping the dotted path of every member, including nested
+        structs and their members, to its (offset, layout). The elements of
+        arrays of structs aren't in the table, see field().
+        """
+        try:
+            return self._paths
+        except AttributeError:
+            paths = {}
+            for i, (name, m) in enumerate(self.members):
+                offset = self.offset_list[i]
+                paths[name] = (offset, m)
+                if type(m) == StructureLayout:
+                    for path, (o, l) in m.paths.items():
+                        paths[name + '.' + path] = (offset + o, l)
+            self._paths = paths
+            return paths
+
+    def field(self, path):
+        """
+        Return the (offset, layout) of the member at a dotted `path`. Elements
+        of arrays of structs and their members are given by index, as in
+        "items[3]" or "items[3].length".
+        """
+        try:
+            return self.paths[path]
+        except KeyError:
+            pass
+        m = _element_path.match(path)
+        if m:
+            o, array = self.paths.get(m.group(1), (None, None))
+            index = int(m.group(2))
+            if type(array) == StructArrayLayout and index < array.array_len:
+                o += index * array.element.size
+                if m.group(3) is None:
+                    return o, array.element
+                try:
+                    eo, l = array.element.field(m.group(3))
+                    return o + eo, l
+                except NameError:
+                    pass
+        raise NameError("No member named '%s' in struct %s" % (path, self.name))
+
+    def offsetof(self, path):
+        """
+        Return the offset in bytes of the member at a dotted `path`.
+        """
+        return self.field(path)[0]
+
+    def parse_many(self, buffer, count=None, offset=0, batch=65536):
+        """
+        Parse `count` consecutive records from `buffer` starting at `offset`,
+        or as many as the buffer holds if `count` is None, into columns.
+        """
+        size = self.size
+        available = (len(buffer) - offset) // size
+        if count is None:
+            count = available
+        elif count > available:
+            raise ValueError("Buffer holds %d records, %d requested" % (available, count))
+
+        # one column per basic member, arrays where the values will fit in one
+        fields = self.flatten()
+        columns = OrderedDict()
+        for path, m, index, o in fields:
+            if m.count == 1 and m.typecode:
+                columns[path] = array.array(m.typecode)
+            else:
+                columns[path] = []
+
+        # unpack a batch of records at a time and transpose them into the columns
+        records = iter_unpack(self.codec, buffer, offset, count)
+        while count > 0:
+            rows = list(itertools.islice(records, min(batch, count)))
+            count -= len(rows)
+            values = list(zip(*rows))
+            for path, m, index, o in fields:
+                if m.count == 1:
+                    columns[path].extend(values[index])
+                else:
+                    columns[path].extend(zip(*values[index:index + m.count]))
+
+        return columns
+
+    def projection(self, fields):
+        """
+        Return (codec, convert, members) for decoding only the members at the
+        dotted paths in `fields`. `codec` unpacks a whole record but skips
+        the bytes of every other member, so it gives just the values of
+        `fields` in the order they appear in the struct. `convert` turns one
+        of those tuples into a tuple with a value for each field, in the order
+        of `fields` (or is None when no conversion is needed), and `members`
+        has a (path, member, index) tuple for each field, where `index` is
+        the position of its first value in the unpacked tuple.
+
+        Fields that overlap, like the members of a union, are unpacked
+        together as a string of the bytes they cover, and `convert` decodes
+        each of them from it. Their `index` is None, so their values are only
+        given by `convert`.
+        """
+        fields = tuple(fields)
+        try:
+            return self._projections[fields]
+        except AttributeError:
+            self._projections = {}
+        except KeyError:
+            pass
+        if not fields:
+            raise ValueError("No fields to project")
+        if len(set(fields)) != len(fields):
+            raise ValueError("Duplicate fields in %r" % (fields,))
+
+        found = []
+        for path in fields:
+            o, m = self.field(path)
+            if type(m) != MemberLayout:
+                kind = 'union' if getattr(m, 'union', False) else 'struct'
+                raise TypeError("'%s' is a %s, project its members instead" % (path, kind))
+            found.append((o, path, m))
+
+        # group the fields into runs of overlapping bytes
+        spans = []
+        for o, path, m in sorted(found, key=lambda f: f[0]):
+            if spans and o < spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], o + m.size)
+                spans[-1][2].append((o, path, m))
+            else:
+                spans.append([o, o + m.size, [(o, path, m)]])
+
+        # skip the bytes before, between and after the members we want
+        formats = []
+        indexes = {}
+        exprs = {}
+        namespace = {}
+        position = index = 0
+        for start, end, group in spans:
+            if start > position:
+                formats.append('%dx' % (start - position))
+            if len(group) == 1:
+                o, path, m = group[0]
+                formats.append(m.raw_format)
+                indexes[path] = index
+                exprs[path] = 'v[%d]' % index if m.count == 1 else 'list(v[%d:%d])' % (index, index + m.count)
+                index += m.count
+            else:
+                # overlapping fields, unpack their bytes once and decode each of them from those
+                formats.append('%ds' % (end - start))
+                for o, path, m in group:
+                    decode = 'decode_%d' % len(namespace)
+                    namespace[decode] = m.decode
+                    indexes[path] = None
+                    exprs[path] = '%s(v[%d], %d)' % (decode, index, o - start)
+                index += 1
+            position = end
+        if position < self.size:
+            formats.append('%dx' % (self.size - position))
+        codec = codec_for(self.endian_format + ''.join(formats))
+
+        # generate a function to put the values in the order they were asked for, unless they already are
+        members = [(path, m, indexes[path]) for o, path, m in found]
+        exprs = [exprs[path] for o, path, m in found]
+        if exprs == ['v[%d]' % i for i in range(len(exprs))]:
+            convert = None
+        else:
+            convert = eval('lambda v: (%s,)' % ', '.join(exprs), namespace)
+
+        projection = self._projections[fields] = (codec, convert, members)
+        return projection
+
+    def matcher(self, where, vectorize=None):
+        """
+        Compile the predicates in `where` (see Structure.filter) into a
+        function match(buffer, offset, count) that returns the indexes of the
+        records that match out of `count` back-to-back records in `buffer`
+        starting at `offset`. If `vectorize` is set (or it's None and numpy is
+        available) the records are tested together with numpy.
+        """
+        tests = []
+        for path, p in sorted(where.items()):
+            o, m = self.field(path)
+            if type(m) != MemberLayout or m.count != 1:
+                raise TypeError("Only basic members and strings can be filtered on, not '%s'" % path)
+            if not isinstance(p, Predicate):
+                p = Equal(p)
+            tests.append((path, m, o, p))
+        if not tests:
+            raise ValueError("No predicates to filter on")
+        if vectorize is None:
+            vectorize = numpy is not None
+
+        if vectorize:
+            if numpy is None:
+                raise ImportError("numpy is required for vectorized filtering")
+
+            # a dtype with just the members we're testing at their offsets
+            dtype = numpy.dtype({'names': [t[0] for t in tests], 'formats': [t[1].dtype[0] for t in tests],
+                                 'offsets': [t[2] for t in tests], 'itemsize': self.size})
+
+            def match(buffer, offset, count):
+                records = numpy.frombuffer(buffer, dtype, count, offset)
+                mask = tests[0][3].mask(records[tests[0][0]])
+                for path, m, o, p in tests[1:]:
+                    mask &= p.mask(records[path])
+                return numpy.flatnonzero(mask).tolist()
+            return match
+
+        # unpack just the members we're testing and generate a function testing them all
+        codec, convert, members = self.projection([t[0] for t in tests])
+        namespace = {'nul': b'\0'}
+
+        def const(value):
+            name = 'c%d' % len(namespace)
+            namespace[name] = value
+            return name
+        # overlapping members are only decoded by convert, which gives the value of each test in turn
+        overlap = any(index is None for path, m, index in members)
+        exprs = []
+        for k, ((path, m, o, p), (path, m, index)) in enumerate(zip(tests, members)):
+            # strings are compared without their trailing nuls, as numpy does
+            value = ('v[%d].rstrip(nul)' if m.char == 's' else 'v[%d]') % (k if overlap else index)
+            exprs.append('(%s)' % p.expr(value, const))
+        test = eval('lambda rows: [i for i, v in enumerate(rows) if %s]' % ' and '.join(exprs), namespace)
+
+        def match(buffer, offset, count):
+            rows = iter_unpack(codec, buffer, offset, count)
+            if overlap:
+                rows = map(convert, rows)
+            return test(rows)
+        return match
+
+    @property
+    def dtype(self):
+        """
+        An equivalent numpy structured dtype for this layout.
+        """
+        if numpy is None:
+            raise ImportError("numpy is required for dtype support")
+        try:
+            return self._dtype
+        except AttributeError:
+            fields = []
+            for name, m in self.members:
+                if type(m) == StructureLayout:
+                    fields.append((name, m.dtype))
+                elif type(m) == StructArrayLayout:
+                    fields.append((name, m.element.dtype, (m.array_len,)))
+                else:
+                    fields.append((name,) + m.dtype)
+            if self.align > 1 or self.union:
+                # give the offsets and size explicitly so numpy leaves room for the padding and overlaps union members
+                self._dtype = numpy.dtype({'names': [f[0] for f in fields], 'offsets': self.offset_list,
+                                           'formats': [f[1] if len(f) == 2 else f[1:] for f in fields],
+                                           'itemsize': self.size})
+            else:
+                self._dtype = numpy.dtype(fields)
+            return self._dtype
+
+    def serialize(self):
+        """
+        Return this layout as nested tuples of names, type names and array
+        lengths that can be stored by a LayoutCache.
+        """
+        members = []
+        for name, m in self.members:
+            if type(m) == StructureLayout:
+                members.append((name, None, m.serialize()))
+            elif type(m) == StructArrayLayout:
+                members.append((name, 'struct[]', (m.element.serialize(), m.array_len)))
+            else:
+                members.append((name, m.type_name, m.array_len))
+        if self.union:
+            return (self.name, members, 'union')
+        return (self.name, members)
+
+    @classmethod
+    def deserialize(cls, data, mode=MODE_LP64, endian=ENDIAN_LITTLE):
+        """
+        Rebuild a layout from the output of serialize() without parsing any C.
+        A struct that couldn't be resolved is stored as just its name, and
+        gives None.
+        """
+        if data[1] is None:
+            return None
+        layout = cls(mode=mode, endian=endian, union='union' in data[2:])
+        layout.name, members = data[:2]
+        for name, type_name, extra in members:
+            if type_name is None:
+                member = cls.deserialize(extra, mode, endian)
+            elif type_name == 'struct[]':
+                member = StructArrayLayout(cls.deserialize(extra[0], mode, endian), extra[1])
+            else:
+                member = MemberLayout(type_name, mode, extra, endian)
+            layout.members.append((name, member))
+        layout.compile()
+        return layout
+
+    def compile(self):
+        # work out the offset of each member, and its position in the per-instance value list. members are padded to
+        # their alignment, and the struct to the largest alignment of its members, which is 1 unless the mode is aligned
+        self.offsets = {}
+        self.indexes = {}
+        self.offset_list = []
+        self.layouts = []
+        self.nested = set()
+        self.arrays = set()
+        self.align = 1
+        formats = []
+        offset = size = 0
+        for i, (name, m) in enumerate(self.members):
+            if self.union:
+                # the members of a union overlap
+                offset = 0
+            pad = -offset % m.align
+            if pad:
+                formats.append('%dx' % pad)
+                offset += pad
+            self.offsets[name] = offset
+            self.indexes[name] = i
+            self.offset_list.append(offset)
+            self.layouts.append(m)
+            if type(m) == StructureLayout:
+                self.nested.add(i)
+            elif type(m) == StructArrayLayout:
+                self.arrays.add(i)
+            formats.append(m.raw_format)
+            self.align = max(self.align, m.align)
+            offset += m.size
+            size = max(size, offset)
+        pad = -size % self.align
+        if self.union:
+            # a union is unpacked as its bytes
+            self.raw_format = '%ds' % (size + pad)
+        else:
+            if pad:
+                formats.append('%dx' % pad)
+            self.raw_format = ''.join(formats)
+
+        # members whose values are containers (nested structs and arrays of structs) rather than decoded values
+        self.containers = self.nested | self.arrays
+
+        # compile a single codec covering every member and the padding, including nested structs. code and the path
+        # table are generated when they're needed
+        self.codec = codec_for(self.endian_format + self.raw_format)
+        self.__dict__.pop('_code', None)
+        self.__dict__.pop('_paths', None)
+        self.__dict__.pop('_projections', None)
+
+    @property
+    def code(self):
+        """
+        The functions generated for this layout, see generate().
+        """
+        try:
+            return self._code
+        except AttributeError:
+            self._code = self.generate()
+            return self._code
+
+    def generate(self):
+        """
+        Generate and compile straight-line Python functions for this layout,
+        with every member's position, offset and format inlined:
+
+            parse(obj, data, offset=0)  parse a structure from a buffer
+            load(obj, v)                fill a structure from an unpacked tuple
+            dump(obj)                   return a structure's values as a tuple
+            pack(obj)                   pack a structure into a string
+            to_dict(v)                  convert an unpacked tuple to a dict
+
+        The source is kept in the `source` attribute of the returned object
+        for debugging, and is registered with linecache so it shows up in
+        tracebacks.
+        """
+        if self.union:
+            return self._generate_union()
+
+        load = []
+        setup = []
+        guards = ['obj._buffer is not None']
+        items = []
+        helpers = {}
+        self._generate_members('obj', '', 0, 0, load, setup, guards, items, helpers)
+
+        # group scalars into tuple literals and concatenate them with the arrays
+        parts = []
+        for expr, count in items:
+            if count == 1:
+                if not parts or parts[-1][0] != '(':
+                    parts.append('(')
+                parts[-1] += '\n        %s,' % expr
+            else:
+                parts.append('tuple(%s)' % expr)
+        parts = [p + '\n    )' if p[0] == '(' else p for p in parts]
+
+        source = '\n'.join(
+            ['# struct %s %s %s' % (self.name, self.mode, self.endian),
+             'def parse(obj, data, offset=0):',
+             '    load(obj, unpack_from(data, offset))',
+             '',
+             'def load(obj, v):'] + load +
+            ['',
+             'def dump(obj):'] + setup +
+            ['    if %s:' % ' or '.join(guards),
+             '        # views and lazily parsed structures take the slow path',
+             '        return fallback(obj)',
+             '    return %s' % ' + '.join(parts or ['()']),
+             '',
+             'def pack(obj):',
+             '    return pack_(*dump(obj))',
+             '',
+             'def to_dict(v):',
+             '    return %s' % self._generate_dict(0, '    ', helpers)[0],
+             ''])
+
+        filename = '<destructor %s %d>' % (self.name, next(_generated))
+        namespace = {
+            'unpack_from':  self.codec.unpack_from,
+            'pack_':        self.codec.pack,
+            'fallback':     _dump_values,
+            'StructArray':  StructArray,
+        }
+        namespace.update(helpers)
+        exec(compile(source, filename, 'exec'), namespace)
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+
+        code = GeneratedCode()
+        code.source = source
+        for name in ('parse', 'load', 'dump', 'pack', 'to_dict'):
+            setattr(code, name, namespace[name])
+        return code
+
+    def _generate_union(self):
+        # generate the functions for a union. structures for unions are views, on their own copy of the bytes they
+        # were loaded from or on the buffer of the structure they're in
+        helpers = {}
+        lines = ['{']
+        for name, m in self.members:
+            func = 'decode_%d' % len(helpers)
+            helpers[func] = m.decode if type(m) == MemberLayout else m.decode_dict
+            lines.append('        %r: %s(v[0]),' % (name, func))
+        lines.append('    }')
+
+        source = '\n'.join(
+            ['# union %s %s %s' % (self.name, self.mode, self.endian),
+             'def parse(obj, data, offset=0):',
+             '    obj.bind(bytearray(data[offset:offset + %d]))' % self.size,
+             '',
+             'def load(obj, v):',
+             '    obj.bind(bytearray(v[0]))',
+             '',
+             'def dump(obj):',
+             '    return (bytes(obj._buffer[obj._offset:obj._offset + %d]),)' % self.size,
+             '',
+             'def pack(obj):',
+             '    return pack_(*dump(obj))',
+             '',
+             'def to_dict(v):',
+             '    return %s' % '\n'.join(lines),
+             ''])
+
+        filename = '<destructor %s %d>' % (self.name, next(_generated))
+        namespace = {'pack_': self.codec.pack}
+        namespace.update(helpers)
+        exec(compile(source, filename, 'exec'), namespace)
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+
+        code = GeneratedCode()
+        code.source = source
+        for name in ('parse', 'load', 'dump', 'pack', 'to_dict'):
+            setattr(code, name, namespace[name])
+        return code
+
+    def _generate_members(self, var, path, index, offset, load, setup, guards, items, helpers):
+        # emit the code for our members and those of nested structs, where `var` is the name of the structure
+        # instance and `index` is the position of our first value in the unpacked tuple. objects the code refers to
+        # are added to `helpers`
+        load.append('    %s._buffer = None' % var)
+        load.append('    %s._lazy = False' % var)
+        load.append('    %s_values = %s._values' % (var, var))
+        setup.append('    %s_values = %s._values' % (var, var))
+        for i, (name, m) in enumerate(self.members):
+            comment = '# %s%s @ %d %r' % (path, name, offset + self.offset_list[i], m.format)
+            if type(m) == StructureLayout and m.union:
+                # unions are views on a copy of their bytes
+                pack = 'pack_%d' % len(helpers)
+                helpers[pack] = m.code.pack
+                load.append('    %s_values[%d].bind(bytearray(v[%d]))  %s' % (var, i, index, comment))
+                items.append(('%s(%s_values[%d])' % (pack, var, i), 1))
+                index += 1
+            elif type(m) == StructureLayout:
+                nested = '%s_%d' % (var, i)
+                load.append('    %s = %s_values[%d]  %s' % (nested, var, i, comment))
+                setup.append('    %s = %s_values[%d]' % (nested, var, i))
+                guards.append('%s._buffer is not None' % nested)
+                index = m._generate_members(nested, path + name + '.', index, offset + self.offset_list[i], load,
+                                            setup, guards, items, helpers)
+            elif type(m) == StructArrayLayout:
+                # the values of every element are kept in one block and only loaded into elements when they're used
+                layout = 'array_%d' % len(helpers)
+                helpers[layout] = m
+                load.append('    %s_values[%d] = StructArray(%s, v[%d:%d])  %s' % (var, i, layout, index, index + m.count,
+                                                                               comment))
+                items.append(('%s_values[%d].dump()' % (var, i), m.count))
+                index += m.count
+            elif m.count == 1:
+                load.append('    %s_values[%d] = v[%d]  %s' % (var, i, index, comment))
+                items.append(('%s_values[%d]' % (var, i), 1))
+                index += 1
+            else:
+                load.append('    %s_values[%d] = list(v[%d:%d])  %s' % (var, i, index, index + m.count, comment))
+                items.append(('%s_values[%d]' % (var, i), m.count))
+                index += m.count
+        return index
+
+    def _generate_dict(self, index, indent, helpers):
+        # return a dict literal for our members taking values from `v` starting at `index`, and the next index
+        lines = ['{']
+        for name, m in self.members:
+            if type(m) == StructureLayout and m.union:
+                func = 'to_dict_%d' % len(helpers)
+                helpers[func] = m.decode_dict
+                expr = '%s(v[%d])' % (func, index)
+                index += 1
+            elif type(m) == StructureLayout:
+                expr, index = m._generate_dict(index, indent + '    ', helpers)
+            elif type(m) == StructArrayLayout:
+                func = 'to_dict_%d' % len(helpers)
+                helpers[func] = m.element.code.to_dict
+                c = m.element.count
+                expr = '[%s(v[j:j + %d]) for j in range(%d, %d, %d)]' % (func, c, index, index + m.count, c)
+                index += m.count
+            elif m.count == 1:
+                expr = 'v[%d]' % index
+                index += 1
+            else:
+                expr = 'list(v[%d:%d])' % (index, index + m.count)
+                index += m.count
+            lines.append('%s    %r: %s,' % (indent, name, expr))
+        lines.append(indent + '}')
+        return '\n'.join(lines), index
+
+    def parse_decl(self, decl, tr, ss=None):
+        mode = self.mode
+        self.members = []
 
-        index = 0
         for name, node in decl.children():
             # process the type
             if type(node.type) == pycparser.c_ast.PtrDecl:
                 # find the type node hanging off this pointer node and resolve it
-                t = NodeFinder(pycparser.c_ast.TypeDecl).find(node)[0]
-                t = self._tr.resolve_type(t)
+                t = find_node(node, pycparser.c_ast.TypeDecl)
+                t = tr.resolve_type(t)
 
                 # get the name of the underlying type and add a * because it's a pointer
-                type_name = self._tr.name_for_type(t) + ' *'
+                type_name = tr.name_for_type(t) + ' *'
 
                 # instantiate the member
-                member = StructureMember(name=node.name, node=node, type_name=type_name, mode=mode,
-                                         endian=self._endian)
-                self._members[node.name] = member
-                self._members_ord.append(member)
+                member = MemberLayout(type_name, mode, endian=self.endian)
             elif type(node.type) == pycparser.c_ast.TypeDecl:
                 # see if this is a nested struct
-                s = self._tr.find_struct_node(node.type)
+                s = tr.find_struct_node(node.type)
                 if s:
-                    # it is, find the first declaration of this struct name
-                    if self._ss:
-                        s = self._ss.decl_named(s.name)
+                    # it is, if it's a reference to a struct or union declared elsewhere find the first declaration
+                    # of it
+                    if s.decls is None and ss:
+                        s = _declaration(ss, s)
 
                     # and process it
-                    member = Structure(decl=s, ast=self._ast, mode=mode, endian=self._endian)
+                    member = StructureLayout(decl=s, tr=tr, ss=ss, mode=mode, endian=self.endian)
                 else:
                     # otherwise, resolve this type if it's a typedef
-                    t = self._tr.resolve_type(node.type)
+                    t = tr.resolve_type(node.type)
 
                     # get its name
-                    type_name = self._tr.name_for_type(t)
+                    type_name = tr.name_for_type(t)
 
                     # instantiate the member
-                    member = StructureMember(name=node.name, node=node, type_name=type_name, mode=mode,
-                                             endian=self._endian)
-
-                # store the new member
-                self._members[node.name] = member
-                self._members_ord.append(member)
+                    member = MemberLayout(type_name, mode, endian=self.endian)
+            elif type(node.type) == pycparser.c_ast.ArrayDecl and tr.find_struct_node(node.type.type):
+                # an array of structs, find the first declaration of the struct if it's declared elsewhere
+                s = tr.find_struct_node(node.type.type)
+                if s.decls is None and ss:
+                    s = _declaration(ss, s)
+                element = StructureLayout(decl=s, tr=tr, ss=ss, mode=mode, endian=self.endian)
+                member = StructArrayLayout(element, int(node.type.dim.value))
             elif type(node.type) == pycparser.c_ast.ArrayDecl:
                 # find the type node hanging off this array node and resolve it
-                t = NodeFinder(pycparser.c_ast.TypeDecl).find(node)[0]
-                t = self._tr.resolve_type(t)
+                t = find_node(node, pycparser.c_ast.TypeDecl)
+                t = tr.resolve_type(t)
 
                 # get the name of the underlying type
-                type_name = self._tr.name_for_type(t)
+                type_name = tr.name_for_type(t)
 
                 # get the array length
                 array_len = int(node.type.dim.value)
 
                 # instantiate the member
-                member = StructureMember(name=node.name, node=node, type_name=type_name, mode=mode,
-                                         endian=self._endian, array_len=array_len)
-                self._members[node.name] = member
-                self._members_ord.append(member)
+                member = MemberLayout(type_name, mode, array_len, self.endian)
             elif type(node.type) == pycparser.c_ast.Struct:
                 raise NotImplementedError("Nested structs aren't supported yet")
+            elif type(node.type) == pycparser.c_ast.Union:
+                raise NotImplementedError("Anonymous unions aren't supported yet")
             else:
                 raise Exception("Unexpected node of type: %s" % (str(node.type)))
-            index += 1
+
+            # store the new member
+            self.members.append((node.name, member))
+
+        self.compile()
+
+
+# marks a value of a lazily parsed structure that hasn't been decoded from its buffer yet
+_PENDING = object()
+
+# a path to an element of an array of structs, and optionally a member of it
+_element_path = re.compile(r'^(.+?)\[(\d+)\](?:\.(.+))?$')
+
+
+class Structure(object):
+    """
+    A structure. Initialise this with the source for a struct definition. If
+    multiple struct definitions are found the first one will be used.
+
+    The layout of the struct is resolved the first time a class is instantiated
+    with a given mode and endianness and cached on the class, so subsequent
+    instances don't need to parse any C source. If a LayoutCache (or a cache
+    directory) is given via `cache` or the `_cache` class attribute, layouts
+    are also stored on disk and reused by later processes.
+
+    Instances only hold a reference to the shared layout and a single list of
+    member values (nested structs are Structure instances in the list). The
+    members returned by attribute access are accessors for that list.
+    Subclasses can declare `__slots__ = ()` to avoid a per-instance dict.
+    """
+    __slots__ = ('_layout', '_values', '_buffer', '_offset', '_lazy')
+
+    _source = None
+    _name = None
+    _cache = None
+
+    # set on classes created by a StructureSet
+    _ss = None
+    _index = None
+    _decl = None
+    _ast = None
+
+    def __init__(self, binary=None, source=None, filename=None, decl=None, ast=None, mode=MODE_LP64, endian=ENDIAN_LITTLE,
+                 cache=None):
+        layout = self.layout_for(mode, endian, source=source, filename=filename, decl=decl, ast=ast, cache=cache)
+        self._allocate(layout)
+
+        # if we got a binary, parse it
+        if binary:
+            if isinstance(binary, (str, bytes, bytearray)):
+                self.parse(binary)
+            else:
+                self.read(binary)
+
+    @classmethod
+    def layout_for(cls, mode=MODE_LP64, endian=ENDIAN_LITTLE, source=None, filename=None, decl=None, ast=None,
+                   cache=None):
+        """
+        Return the StructureLayout for this class with the given mode and
+        endianness.
+        """
+        # find the cached layout for this class, or resolve it if this is the first time we've seen this combination
+        # of source, mode and endianness
+        if '_layouts' not in cls.__dict__:
+            cls._layouts = {}
+        key = (source, filename, decl, mode, endian)
+        try:
+            return cls._layouts[key]
+        except KeyError:
+            layout = cls._layouts[key] = cls._resolve_layout(source, filename, decl, ast, mode, endian, cache)
+            return layout
+
+    @classmethod
+    def from_layout(cls, layout):
+        """
+        Create an instance from an already resolved StructureLayout.
+        """
+        obj = cls.__new__(cls)
+        obj._allocate(layout)
+        return obj
+
+    @classmethod
+    def _resolve_layout(cls, source, filename, decl, ast, mode, endian, cache=None):
+        # if we didn't have any source provided by our subclass, override it with what was passed to __init__()
+        if cls._source:
+            source = cls._source
+
+        # parse source/file if we got some
+        if source or filename:
+            # create a structure set and find the structure by name if one was given, otherwise grab the first struct
+            ss = StructureSet(source=source, filename=filename, cache=cache or cls._cache, mode=mode, endian=endian)
+            return ss.layout(ss.index_of(cls._name), mode, endian)
+
+        # if this class came from a StructureSet, ask it for the layout
+        if cls._ss is not None and cls._index is not None:
+            return cls._ss.layout(cls._index, mode, endian)
+
+        # otherwise we were given a declaration directly. use the class's ast and decl if we have them
+        if cls._ast:
+            ast = cls._ast
+        if cls._decl:
+            decl = cls._decl
+
+        # find any typedefs we might need and parse the declarator for our member info
+        return StructureLayout(decl=decl, tr=TypeResolver(ast), ss=cls._ss, mode=mode, endian=endian)
+
+    def _allocate(self, layout):
+        # create the per-instance value storage for a layout
+        self._layout = layout
+        self._buffer = None
+        self._offset = 0
+        self._lazy = False
+        self._values = values = [None] * len(layout.layouts)
+        for i in layout.nested:
+            values[i] = Structure.from_layout(layout.layouts[i])
+        for i in layout.arrays:
+            values[i] = StructArray(layout.layouts[i])
+
+        # unions are always views, on their own bytes until they're bound to something else, and so are the structs
+        # and arrays in them
+        if layout.union:
+            self.bind(bytearray(layout.size))
+
+    @property
+    def _members(self):
+        return dict((name, self._member(i)) for name, i in self._layout.indexes.items())
+
+    @property
+    def _members_ord(self):
+        return [self._member(i) for i in range(len(self._values))]
+
+    def _member(self, index):
+        # nested structs and arrays of structs are returned as they are, basic members via an accessor for their value
+        if index in self._layout.containers:
+            return self._get(index)
+        return StructureMember.accessor(self._layout.layouts[index], self, index)
+
+    @property
+    def _mode(self):
+        return self._layout.mode
+
+    @property
+    def _endian(self):
+        return self._layout.endian
+
+    @property
+    def _codec(self):
+        return self._layout.codec
+
+    def __str__(self):
+        return self.packed
+
+    @property
+    def size(self):
+        return self._layout.size
+
+    @property
+    def endian(self):
+        return self._layout.endian
+
+    @property
+    def endian_format(self):
+        return self._layout.endian_format
+
+    @property
+    def raw_format(self):
+        return self._layout.raw_format
+
+    @property
+    def count(self):
+        return self._layout.count
+
+    @property
+    def format(self):
+        return self._layout.format
+
+    @property
+    def packed(self):
+        return self._layout.code.pack(self)
+
+    def to_dict(self):
+        """
+        Return the values of the members as a dict, with nested structs as
+        nested dicts.
+        """
+        code = self._layout.code
+        return code.to_dict(code.dump(self))
+
+    @layoutmethod
+    def generated_source(cls, layout):
+        """
+        Return the source of the parse, pack and to_dict functions generated
+        for this structure's layout.
+        """
+        return layout.code.source
+
+    def parse_decl(self, decl, mode=MODE_LP64, ast=None):
+        self._allocate(StructureLayout(decl=decl, tr=TypeResolver(ast or self._ast), ss=self._ss, mode=mode,
+                                       endian=self._endian))
 
     def __getattr__(self, name):
-        if not name.startswith('_') and name in self._members:
-            return self._members[name]
+        if not name.startswith('_'):
+            index = self._layout.indexes.get(name)
+            if index is not None:
+                return self._member(index)
+
+    def _get(self, index):
+        # return the value of a member
+        value = self._values[index]
+        if self._buffer is not None:
+            if value is _PENDING:
+                # parsed lazily and this is the first access, decode and keep it
+                value = self._values[index] = self._decode(index)
+            elif not self._lazy and index not in self._layout.containers:
+                # we're a view, decode it from the buffer every time
+                value = self._decode(index)
+        return value
+
+    def _set(self, index, value):
+        # set the value of a member, packing it straight into the buffer if we're a view
+        if self._buffer is not None and not self._lazy:
+            self._layout.layouts[index].pack_into(self._buffer, self._offset + self._layout.offset_list[index], value)
+        else:
+            self._values[index] = value
+
+    def _decode(self, index):
+        return self._layout.layouts[index].decode(self._buffer, self._offset + self._layout.offset_list[index])
 
     def read(self, infile, offset=0):
+        # memory mapped files can be parsed directly
+        if isinstance(infile, MappedFile):
+            infile = infile.map
+        if isinstance(infile, mmap.mmap):
+            self.parse(infile, offset)
+            return
+
+        # read the whole structure in one go and parse it from memory
         infile.seek(offset)
-        for m in self._members_ord:
-            m.read(infile)
-
-    def parse(self, data, offset=0):
-        for m in self._members_ord:
-            m.parse(data, offset)
-            offset += m.size
+        self.parse(infile.read(self.size))
+
+    def parse(self, data, offset=0, lazy=False):
+        """
+        Parse the structure from `data` at `offset`. If `lazy` is set, nothing
+        is decoded yet. Instead each member is decoded from `data` the first
+        time it's accessed, and nested structs are parsed lazily in turn, so
+        `data` should not be modified until the structure is finished with.
+        """
+        if lazy and not self._layout.union:
+            layout = self._layout
+            values = self._values
+            for i in range(len(values)):
+                if i in layout.nested:
+                    values[i].parse(data, offset + layout.offset_list[i], lazy=True)
+                else:
+                    values[i] = _PENDING
+            self._buffer = data
+            self._offset = offset
+            self._lazy = True
+        else:
+            self._layout.code.parse(self, data, offset)
+
+    @layoutmethod
+    def offsetof(cls, layout, path):
+        """
+        Return the offset in bytes of the member at a dotted `path`, such as
+        "hdr.length" for the `length` member of the nested struct `hdr`.
+        """
+        return layout.field(path)[0]
+
+    @layoutmethod
+    def peek(cls, layout, buffer, path, offset=0):
+        """
+        Decode just the member at a dotted `path` of a structure at `offset` in
+        `buffer` (a string, bytearray, mmap or MappedFile), without parsing the
+        rest of it. A nested struct is returned as a parsed Structure.
+        """
+        if isinstance(buffer, MappedFile):
+            buffer = buffer.map
+        o, m = layout.field(path)
+        if type(m) == StructureLayout:
+            obj = Structure.from_layout(m)
+            obj.parse(buffer, offset + o)
+            return obj
+        return m.decode(buffer, offset + o)
+
+    def _materialize(self):
+        # decode any members of a lazily parsed structure that haven't been accessed yet
+        values = self._values
+        for i in range(len(values)):
+            if values[i] is _PENDING:
+                values[i] = self._decode(i)
+        self._buffer = None
+        self._lazy = False
+
+    @layoutmethod
+    def view(cls, layout, buffer, offset=0):
+        """
+        Return a structure that is a view on `buffer` at `offset`. Members are
+        decoded from the buffer when their value is read, and packed straight
+        into it when their value is set, so the buffer (a bytearray, mmap or
+        anything else writable) is the only copy of the data.
+        """
+        obj = cls.from_layout(layout)
+        obj.bind(buffer, offset)
+        return obj
+
+    def bind(self, buffer, offset=0):
+        """
+        Make this structure a view on `buffer` at `offset`.
+        """
+        self._buffer = buffer
+        self._offset = offset
+        self._lazy = False
+        for i in self._layout.nested:
+            self._values[i].bind(buffer, offset + self._layout.offset_list[i])
+        for i in self._layout.arrays:
+            self._values[i] = StructArray(self._layout.layouts[i], buffer=buffer,
+                                          offset=offset + self._layout.offset_list[i], view=True)
+
+    def unbind(self):
+        """
+        Stop viewing a buffer, keeping a copy of the values it holds.
+        """
+        self._layout.code.parse(self, self._buffer, self._offset)
+
+    @layoutmethod
+    def parse_many(cls, layout, buffer, count=None, offset=0):
+        """
+        Parse `count` back-to-back records from `buffer` starting at `offset`,
+        or as many as the buffer holds if `count` is None, in a single pass.
+
+        Returns an OrderedDict mapping each member to a column of values.
+        Members of nested structs are flattened into dotted names like
+        'm_nest.m1'. Numeric members are stored in array.array columns, and
+        strings, chars, bools and arrays (as tuples) in lists.
+        """
+        return layout.parse_many(buffer, count, offset)
+
+    @layoutmethod
+    def parse_parallel(cls, layout, source, count=None, offset=0, reduce=None, workers=None, chunk_size=1 << 23,
+                       executor=None):
+        """
+        Parse `count` back-to-back records from a file starting at `offset`,
+        or every record to the end of the file if `count` is None, across a
+        pool of processes. `source` is a filename, a MappedFile or an open
+        file. The records are split into record-aligned ranges of about
+        `chunk_size` bytes, and each worker maps the file and parses its
+        ranges with parse_many(), so the records are never pickled.
+
+        Returns the columns for all of the records, like parse_many(). If a
+        `reduce` callable is given, it's called in the worker with the
+        columns for each range, and a list of what it returns for each range
+        is returned instead. `reduce` needs to be picklable, e.g. a module
+        level function.
+
+        A ProcessPoolExecutor with `workers` processes (one per CPU by
+        default) is created for the call, unless an executor is given.
+        Requires concurrent.futures (the `futures` package on Python 2).
+        """
+        if futures is None:
+            raise ImportError("concurrent.futures is required for parallel parsing")
+        if isinstance(source, mmap.mmap):
+            raise TypeError("Workers need to map the file themselves, pass a filename or a MappedFile")
+        filename = getattr(source, 'filename', None) or getattr(source, 'name', None) or source
+
+        # split the records into ranges, making sure there's enough of them to keep every worker busy
+        size = layout.size
+        available = (os.path.getsize(filename) - offset) // size
+        if count is None:
+            count = available
+        elif count > available:
+            raise ValueError("File holds %d records, %d requested" % (available, count))
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        per = max(1, min(chunk_size // size, -(-count // workers)))
+        ranges = [(offset + i * size, min(per, count - i)) for i in range(0, count, per)]
+
+        own = executor is None
+        if own:
+            executor = futures.ProcessPoolExecutor(workers)
+        try:
+            data = layout.serialize()
+            jobs = [executor.submit(_parse_range, data, layout.mode, layout.endian, filename, o, n, reduce)
+                    for o, n in ranges]
+            if reduce is not None:
+                return [job.result() for job in jobs]
+
+            # join the columns for each range in order
+            columns = layout.parse_many(b'', 0)
+            for job in jobs:
+                for path, typecode, column in marshal.loads(job.result()):
+                    if typecode:
+                        if hasattr(columns[path], 'frombytes'):
+                            columns[path].frombytes(column)
+                        else:
+                            columns[path].fromstring(column)
+                    else:
+                        columns[path].extend(column)
+            return columns
+        finally:
+            if own:
+                executor.shutdown()
+
+    @layoutmethod
+    def iter_records(cls, layout, fileobj, chunk_size=1 << 20, lazy=False, view=False):
+        """
+        Read back-to-back records from a file-like object or socket in chunks
+        of about `chunk_size` bytes and yield a parsed instance for each one,
+        so memory use doesn't depend on the size of the input. If `lazy` is set
+        the records are parsed lazily, and if `view` is set they are views on
+        a copy of the chunk they were read in, so they can be changed but the
+        changes aren't written back to `fileobj`.
+        """
+        for data, count in iter_chunks(fileobj, layout.size, chunk_size):
+            for obj in _chunk_records(cls, layout, data, count, lazy, view):
+                yield obj
+
+    @layoutmethod
+    def scan(cls, layout, source, fields, count=None, offset=0, chunk_size=1 << 20):
+        """
+        Decode only the members at the dotted paths in `fields` from `count`
+        back-to-back records (or every record) and yield a tuple of their
+        values for each record. The rest of each record is skipped without
+        being decoded. `source` is a string, bytearray, mmap or MappedFile
+        starting at `offset`, or a file-like object or socket (seeked to
+        `offset` if it's given) read in chunks of about `chunk_size` bytes.
+        """
+        codec, convert, members = layout.projection(fields)
+        rows = _scan_rows(codec, source, count, offset, chunk_size)
+        if convert is None:
+            return rows
+        return (convert(v) for v in rows)
+
+    @layoutmethod
+    def filter(cls, layout, source, where, count=None, offset=0, chunk_size=1 << 20, vectorize=None):
+        """
+        Yield a parsed instance for each of `count` back-to-back records (or
+        every record) that matches all of the predicates in `where`, a dict
+        mapping dotted member paths to a Predicate (Equal, Range, BitMask or
+        OneOf) or a value the member must equal. Only the members being tested
+        are decoded from the raw bytes at their offsets, and instances are
+        only built for records that match.
+
+        If numpy is available, each chunk of records is tested at once with
+        numpy unless `vectorize` is False. `source` is as for scan().
+        """
+        match = layout.matcher(where, vectorize)
+        size = layout.size
+        for data, base, n in _record_chunks(source, size, count, offset, chunk_size):
+            for i in match(data, base, n):
+                obj = cls.from_layout(layout)
+                obj.parse(data, base + i * size)
+                yield obj
+
+    @layoutmethod
+    def scan_columns(cls, layout, source, fields, count=None, offset=0, chunk_size=1 << 20, batch=65536):
+        """
+        Like scan(), but return an ordered dict mapping each field to a column
+        of values, as parse_many() does.
+        """
+        codec, convert, members = layout.projection(fields)
+        columns = OrderedDict()
+        for path, m, index in members:
+            if m.count == 1 and m.typecode:
+                columns[path] = array.array(m.typecode)
+            else:
+                columns[path] = []
+
+        rows = _scan_rows(codec, source, count, offset, chunk_size)
+        if any(index is None for path, m, index in members):
+            # overlapping fields are only decoded by convert, which gives a value (or a list) for each field in turn
+            rows = (convert(v) for v in rows)
+            members = [(path, m, None) for path, m, index in members]
+        while True:
+            values = list(zip(*itertools.islice(rows, batch)))
+            if not values:
+                return columns
+            for k, (path, m, index) in enumerate(members):
+                if index is None:
+                    columns[path].extend(values[k] if m.count == 1 else [tuple(x) for x in values[k]])
+                elif m.count == 1:
+                    columns[path].extend(values[index])
+                else:
+                    columns[path].extend(zip(*values[index:index + m.count]))
+
+    if aio is not None:
+        aiter_records = layoutmethod(aio.aiter_records)
+        awrite_many = layoutmethod(aio.awrite_many)
+
+    @layoutmethod
+    def numpy_dtype(cls, layout):
+        """
+        Return an equivalent numpy structured dtype, honouring the mode and
+        endianness. Requires numpy.
+        """
+        return layout.dtype
+
+    @layoutmethod
+    def frombuffer(cls, layout, buffer, count=-1, offset=0):
+        """
+        Return a numpy array of records viewing `buffer` without copying it.
+        Requires numpy.
+        """
+        return numpy.frombuffer(buffer, dtype=layout.dtype, count=count, offset=offset)
+
+    @layoutmethod
+    def memmap(cls, layout, filename, access='r', offset=0, shape=None):
+        """
+        Return a numpy memmap of records in the file `filename`. `access` is
+        the numpy.memmap mode ('r', 'r+', 'w+' or 'c'). Requires numpy.
+        """
+        return numpy.memmap(filename, dtype=layout.dtype, mode=access, offset=offset, shape=shape)
+
+    def pack_into(self, buffer, offset=0):
+        self._codec.pack_into(buffer, offset, *self._layout.code.dump(self))
+
+    def _dump(self, values):
+        # append our values to a list to be packed by the codec. views take their values straight from the buffer
+        if self._buffer is not None:
+            if not self._lazy:
+                values.extend(self._codec.unpack_from(self._buffer, self._offset))
+                return
+            self._materialize()
+        for i, m in enumerate(self._layout.layouts):
+            if i in self._layout.nested:
+                self._values[i]._dump(values)
+            elif i in self._layout.arrays:
+                values.extend(self._values[i].dump())
+            elif m.count == 1:
+                values.append(self._values[i])
+            else:
+                values.extend(self._values[i])
 
     def write(self, outfile, offset=0):
+        # memory mapped files can be packed into directly
+        if isinstance(outfile, MappedFile):
+            outfile = outfile.map
+        if isinstance(outfile, mmap.mmap):
+            self.pack_into(outfile, offset)
+            return
+
         outfile.seek(offset)
-        for m in self._members_ord:
-            m.write(outfile)
+        outfile.write(self.packed)
+
+    @layoutmethod
+    def write_many(cls, layout, outfile, records, offset=None):
+        """
+        Write a sequence of records back-to-back. They are packed into one
+        preallocated buffer and written with a single call, at `offset` if it's
+        given or at the current position otherwise. Records are packed straight
+        into a MappedFile or mmap, at `offset` or the start of the mapping.
+        """
+        if not hasattr(records, '__len__'):
+            records = list(records)
+        size = layout.size
+
+        if isinstance(outfile, MappedFile):
+            outfile = outfile.map
+        if isinstance(outfile, mmap.mmap):
+            buf = outfile
+            base = offset or 0
+        else:
+            buf = bytearray(size * len(records))
+            base = 0
+
+        for i, rec in enumerate(records):
+            if rec.size != size:
+                raise ValueError("Record %d is %d bytes, expected %d" % (i, rec.size, size))
+            rec.pack_into(buf, base + i * size)
+
+        if buf is not outfile:
+            if offset is not None:
+                outfile.seek(offset)
+            outfile.write(buf)
+
+
+class StructArray(object):
+    """
+    The value of an array of structs member. Elements are Structure
+    instances, which are only created when they're accessed. The array keeps
+    the values of every element as they were unpacked, in one block, or the
+    buffer the elements are in if the structure was parsed lazily or is a
+    view, so column() can get the values of a member of every element
+    without creating any instances.
+    """
+    __slots__ = ('_layout', '_elements', '_values', '_buffer', '_offset', '_view')
+
+    def __init__(self, layout, values=None, buffer=None, offset=0, view=False):
+        self._layout = layout
+        self._elements = [None] * layout.array_len
+        self._values = values
+        self._buffer = buffer
+        self._offset = offset
+        self._view = view
+
+    def __len__(self):
+        return self._layout.array_len
+
+    def __iter__(self):
+        for i in range(self._layout.array_len):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Struct array index out of range")
+
+        obj = self._elements[index]
+        if obj is None:
+            # first access to this element, load it from the block of values or the buffer
+            element = self._layout.element
+            obj = self._elements[index] = Structure.from_layout(element)
+            if self._values is not None:
+                element.code.load(obj, self._values[index * element.count:(index + 1) * element.count])
+            elif self._view:
+                obj.bind(self._buffer, self._offset + index * element.size)
+            elif self._buffer is not None:
+                element.code.parse(obj, self._buffer, self._offset + index * element.size)
+        return obj
+
+    def __setitem__(self, index, value):
+        # copy the values of a structure into an element
+        element = self._layout.element
+        if value.size != element.size:
+            raise ValueError("Element is %d bytes, expected %d" % (value.size, element.size))
+        obj = self[index]
+        if self._view:
+            value.pack_into(self._buffer, obj._offset)
+        else:
+            element.code.load(obj, element.code.dump(value))
+
+    def column(self, path):
+        """
+        Return a list of the values of the member at the dotted `path` of
+        every element, decoding just that member.
+        """
+        element = self._layout.element
+        if element.union:
+            # each element is unpacked as its bytes, decode the member from them
+            o, m = element.field(path)
+            if self._values is not None:
+                values = [m.decode(v, o) for v in self._values]
+            elif self._buffer is not None:
+                values = [m.decode(self._buffer, self._offset + i * element.size + o) for i in range(len(self))]
+            else:
+                values = [m.decode(bytearray(element.size), o)] * len(self)
+        else:
+            codec, convert, members = element.projection([path])
+            if self._values is not None:
+                # take every element's value out of the block of values. a member of a union is decoded from the
+                # union's bytes
+                for fpath, m, index, o in element.flatten():
+                    if path == fpath or path.startswith(fpath + '.'):
+                        break
+                count, step = members[0][1].count, element.count
+                if path != fpath:
+                    member = members[0][1]
+                    o = element.offsetof(path) - o
+                    values = [member.decode(v, o) for v in self._values[index::step]]
+                elif count == 1:
+                    values = list(self._values[index::step])
+                else:
+                    values = [list(self._values[i:i + count]) for i in range(index, len(self._values), step)]
+            elif self._buffer is not None:
+                rows = iter_unpack(codec, self._buffer, self._offset, len(self))
+                values = [v[0] for v in rows] if convert is None else [convert(v)[0] for v in rows]
+            else:
+                values = [None] * len(self)
+
+        # elements that have been accessed might have been changed, unless they're views on the buffer
+        if not self._view:
+            for i, obj in enumerate(self._elements):
+                if obj is not None:
+                    for name in path.split('.'):
+                        obj = getattr(obj, name)
+                    values[i] = obj.value
+        return values
+
+    def dump(self):
+        """
+        Return the values of every element, in order, as they're packed.
+        """
+        if self._values is not None and all(e is None for e in self._elements):
+            return self._values
+
+        # start with the values of every element as they were unpacked or are in the buffer, then replace the values
+        # of the elements that have been accessed (views are already up to date)
+        if self._values is not None:
+            values = list(self._values)
+        elif self._buffer is not None:
+            values = list(codec_for(self._layout.format).unpack_from(self._buffer, self._offset))
+            if self._view:
+                return values
+        elif self._layout.element.union:
+            values = [bytes(bytearray(self._layout.element.size))] * self._layout.count
+        else:
+            values = [None] * self._layout.count
+        element = self._layout.element
+        count = element.count
+        for i, obj in enumerate(self._elements):
+            if obj is not None:
+                values[i * count:(i + 1) * count] = element.code.dump(obj)
+        return values
+
+
+class MappedFile(object):
+    """
+    A memory mapped file. Open a file once, then create Structure views at
+    any offset that read and write through the mapping, or pass it to
+    Structure.read() and Structure.write().
+
+    If `readonly` is set the file is mapped read-only, which lets the OS page
+    cache do the work for huge files. If `size` is given, a writable file is
+    extended to at least that many bytes before it's mapped (or created with
+    that many bytes if it doesn't exist). An empty file can't be mapped, so
+    `size` is needed for a new or empty file. Changes are
+    written back by the OS as it sees fit, or explicitly with flush(). The
+    whole mapping is flushed on close() unless told otherwise.
+    """
+    def __init__(self, filename, readonly=False, size=None):
+        self.filename = filename
+        self.readonly = readonly
+        if readonly:
+            self.file = open(filename, 'rb')
+            if not os.fstat(self.file.fileno()).st_size:
+                self.file.close()
+                raise ValueError("Can't map the empty file '%s'" % filename)
+        else:
+            if not size and (not os.path.exists(filename) or not os.path.getsize(filename)):
+                raise ValueError("Can't map an empty file, give a size to create '%s' with" % filename)
+            if not os.path.exists(filename):
+                open(filename, 'wb').close()
+            self.file = open(filename, 'r+b')
+            if size and os.fstat(self.file.fileno()).st_size < size:
+                self.file.truncate(size)
+        access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE
+        self.map = mmap.mmap(self.file.fileno(), 0, access=access)
+
+    def __len__(self):
+        return len(self.map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self):
+        return len(self.map)
+
+    def view(self, cls, offset=0, **kwargs):
+        """
+        Return an instance of the Structure subclass `cls` that is a view on
+        the mapping at `offset`. `mode` and `endian` can be given as keyword
+        arguments.
+        """
+        return cls.view(self.map, offset, **kwargs)
+
+    def views(self, cls, offset=0, count=None, **kwargs):
+        """
+        Yield views of `count` back-to-back records starting at `offset`, or of
+        every record until the end of the file if `count` is None.
+        """
+        size = cls.layout_for(kwargs.get('mode', MODE_LP64), kwargs.get('endian', ENDIAN_LITTLE)).size
+        if count is None:
+            count = (len(self.map) - offset) // size
+        for i in range(count):
+            yield cls.view(self.map, offset + i * size, **kwargs)
+
+    def flush(self, offset=0, size=None):
+        """
+        Write changes in the given range (or the whole mapping) back to the
+        file.
+        """
+        if not self.readonly:
+            if size is None:
+                self.map.flush()
+            else:
+                # flush offsets need to be page aligned
+                start = offset - offset % mmap.ALLOCATIONGRANULARITY
+                self.map.flush(start, size + offset - start)
+
+    def close(self, flush=True):
+        if self.map is None:
+            return
+        if flush:
+            self.flush()
+        self.map.close()
+        self.file.close()
+        self.map = None
 
 
 class StructureSet(object):
     """
     A set of structures. Hand this class a header file and then retrieve
     Structure objects by name.
+
+    If a LayoutCache (or a cache directory) is given, the C source is not
+    parsed up front. Layouts are loaded from the cache when an entry exists
+    for the source, mode and endianness, and the source is only parsed when
+    an entry is missing or the AST is asked for.
+
+    If `lazy` is set, the source is never parsed as a whole. It's scanned to
+    index its declarations, and when a struct's layout is first needed only
+    the declarations it depends on (its nested structs and typedefs) are
+    parsed, so the cost depends on the structs that are used rather than the
+    size of the source. Asking a lazy set for its `ast` or `decls` parses
+    the whole source.
     """
-    def __init__(self, source=None, filename=None):
-        self.parser = c_parser.CParser()
+    def __init__(self, source=None, filename=None, cache=None, mode=MODE_LP64, endian=ENDIAN_LITTLE, lazy=False):
+        if cache is not None and not isinstance(cache, LayoutCache):
+            cache = LayoutCache(cache)
+        self.cache = cache
+        self.mode = mode
+        self.endian = endian
+        self.lazy = lazy
+        self.source = None
+        self._parser = None
         if source:
             self.parse_source(source)
         elif filename:
             self.parse_file(filename)
 
-    def parse_source(self, source):
+    @property
+    def parser(self):
+        if self._parser is None:
+            self._parser = c_parser.CParser()
+        return self._parser
+
+    @property
+    def ast(self):
+        if self._ast is None:
+            self._parse()
+        return self._ast
+
+    @property
+    def decls(self):
+        if self._decls is None:
+            self._parse()
+        return self._decls
+
+    @property
+    def names(self):
+        """
+        The names of the struct declarations in the source, in order.
+        """
+        if self._names is None and self.lazy:
+            self._names = self.header.names
+        if self._names is None and self.cache:
+            self._load_cached(self.mode, self.endian)
+        if self._names is None:
+            self._parse()
+        return self._names
+
+    @property
+    def header(self):
+        """
+        A HeaderIndex of the declarations in the source.
+        """
+        if self._header is None:
+            self._header = HeaderIndex(self.source)
+        return self._header
+
+    def parse_source(self, source, layouts=None):
+        """
+        Use `source` for this set. If `layouts` is given it's a dict mapping
+        (mode, endian) to a list of serialized layouts for every struct in the
+        source, which are used instead of resolving them, and the source is
+        only parsed if the AST is asked for.
+        """
+        self.source = source
+        self._ast = None
+        self._decls = None
+        self._names = None
+        self._name_index = None
+        self._decl_index = None
+        self._classes = {}
+        self._layouts = {}
+        self._missing = set()
+        self._header = None
+        self._subsets = {}
+
+        for (mode, endian), data in (layouts or {}).items():
+            self._layouts[(mode, endian)] = [StructureLayout.deserialize(d, mode, endian) for d in data]
+            self._names = [d[0] for d in data]
+
+        # parse the C source now, unless we might be able to avoid it
+        if not self.cache and not self.lazy and not layouts:
+            self._parse()
+
+    @classmethod
+    def compile_many(cls, filenames=(), sources=(), mode=MODE_LP64, endian=ENDIAN_LITTLE, cache=None,
+                     serialized=False, workers=None, executor=None):
+        """
+        Parse and resolve many headers at once across a pool of processes.
+        Takes a list of header `filenames` and/or a list of C `sources`, and
+        returns a list with a StructureSet for each of the files followed by
+        each of the sources, with the layouts for `mode` and `endian` already
+        resolved.
+
+        If `serialized` is set, the serialized layouts for each header (as
+        stored by a LayoutCache) are returned instead. If a `cache` is given,
+        the layouts are stored in it as well.
+
+        A ProcessPoolExecutor with `workers` processes (one per CPU by
+        default) is created for the call, unless an executor is given.
+        Requires concurrent.futures (the `futures` package on Python 2).
+        """
+        if futures is None:
+            raise ImportError("concurrent.futures is required for parallel compilation")
+        if cache is not None and not isinstance(cache, LayoutCache):
+            cache = LayoutCache(cache)
+
+        own = executor is None
+        if own:
+            executor = futures.ProcessPoolExecutor(workers or multiprocessing.cpu_count())
+        try:
+            jobs = [executor.submit(_compile_header, None, f, mode, endian) for f in filenames]
+            jobs += [executor.submit(_compile_header, s, None, mode, endian) for s in sources]
+
+            results = []
+            for job in jobs:
+                source, layouts, elapsed = job.result()
+                if cache:
+                    cache.store(source, mode, endian, layouts, elapsed)
+                if serialized:
+                    results.append(layouts)
+                else:
+                    ss = cls(cache=cache, mode=mode, endian=endian)
+                    ss.parse_source(source, {(mode, endian): layouts})
+                    results.append(ss)
+            return results
+        finally:
+            if own:
+                executor.shutdown()
+
+    def parse_file(self, filename):
+        with open(filename) as f:
+            self.parse_source(f.read())
+
+    def _parse(self):
         # parse the C source
-        self.ast = self.parser.parse(source, filename='<none>')
+        start = time.time()
+        self._ast = self.parser.parse(self.source, filename='<none>')
 
         # find any struct declarations
-        self.decls = NodeFinder(pycparser.c_ast.Struct).find(self.ast)
+        # structs used in unions aren't declarations of their own, like those used in structs
+        self._decls = NodeFinder(pycparser.c_ast.Struct, skip=(pycparser.c_ast.Union,)).find(self._ast)
+        self._names = [d.name for d in self._decls]
 
-    def parse_file(self, filename):
-        self.parse_source(file(filename).read())
+        # find any typedefs we might need
+        self._tr = TypeResolver(self._ast)
+        self._parse_time = time.time() - start
+
+    def _load_cached(self, mode, endian):
+        # load the layouts for this mode and endianness from the cache if there's an entry, only looking once
+        if (mode, endian) in self._missing:
+            return None
+        start = time.time()
+        data = self.cache.load(self.source, mode, endian)
+        if data is None:
+            self._missing.add((mode, endian))
+            return None
+        layouts = [StructureLayout.deserialize(d, mode, endian) for d in data]
+        self.cache.record_load(time.time() - start)
+
+        self._layouts[(mode, endian)] = layouts
+        if self._names is None:
+            self._names = [d[0] for d in data]
+        return layouts
+
+    def layout(self, index, mode=MODE_LP64, endian=ENDIAN_LITTLE):
+        """
+        Return the StructureLayout for the struct declaration at `index`.
+        """
+        if self.lazy:
+            subset, index = self.subset(index)
+            return subset.layout(index, mode, endian)
 
-    def decl_named(self, name):
         try:
-            decl = [d for d in self.decls if d.name == name][0]
-        except IndexError:
-            decl = None
-        return decl
+            layouts = self._layouts[(mode, endian)]
+        except KeyError:
+            layouts = None
+            if self.cache:
+                layouts = self._load_cached(mode, endian)
+                if layouts is None:
+                    # no cache entry, resolve every struct in the source and store them along with the time it
+                    # took to parse and resolve them. parse first, the parse time is added on separately
+                    self.decls
+                    start = time.time()
+                    layouts, data = self.resolve_all(mode, endian)
+                    self.cache.store(self.source, mode, endian, data, time.time() - start + self._parse_time)
+            else:
+                layouts = [None] * len(self.decls)
+            self._layouts[(mode, endian)] = layouts
+
+        if layouts[index] is None:
+            layouts[index] = self.resolve(self.decls[index], mode, endian)
+        return layouts[index]
+
+    def resolve_all(self, mode=MODE_LP64, endian=ENDIAN_LITTLE):
+        """
+        Resolve every struct in the source, for a cache entry. Returns a list
+        of layouts and a list of their serialized forms. A struct that can't
+        be resolved (e.g. it uses a type that isn't supported) doesn't stop
+        the others from being resolved. Its layout is None and it's
+        serialized as just its name, so it's only resolved again, and fails,
+        when it's used.
+        """
+        layouts = []
+        for decl in self.decls:
+            try:
+                layouts.append(self.resolve(decl, mode, endian))
+            except Exception:
+                layouts.append(None)
+        data = [l.serialize() if l is not None else (name, None) for name, l in zip(self.names, layouts)]
+        return layouts, data
+
+    def subset(self, index):
+        """
+        Return (ss, index) where `ss` is a StructureSet for just the source
+        needed to resolve the struct at `index` in this set, and `index` is
+        the position of the struct in it. A reference to a struct resolves to
+        its definition.
+        """
+        chunks, position = self.header.subset(self.header.definition(index))
+        try:
+            ss = self._subsets[chunks]
+        except KeyError:
+            ss = self._subsets[chunks] = StructureSet(source=self.header.text(chunks), cache=self.cache,
+                                                      mode=self.mode, endian=self.endian)
+        return ss, position
+
+    def layout_named(self, name, mode=MODE_LP64, endian=ENDIAN_LITTLE):
+        return self.layout(self.index_of(name), mode, endian)
+
+    def resolve(self, decl, mode=MODE_LP64, endian=ENDIAN_LITTLE):
+        # make sure we've parsed the source before resolving anything
+        self.ast
+        return StructureLayout(decl=decl, tr=self._tr, ss=self, mode=mode, endian=endian)
+
+    def index_of(self, name=None):
+        """
+        Return the index of the declaration that defines the struct `name`
+        (see name_index), or of the first struct declaration if no name is
+        given.
+        """
+        if not len(self.names):
+            raise IndexError("No struct declaration was found")
+        if name is None:
+            return 0
+        try:
+            return self.name_index[name]
+        except KeyError:
+            raise NameError("No struct declaration was found named '%s'" % name)
+
+    @property
+    def name_index(self):
+        """
+        A dict mapping each struct name to the index of its first declaration
+        that defines its members, or of its first declaration if it's never
+        defined.
+        """
+        if self._name_index is None:
+            self._name_index = {}
+            for i, name in enumerate(self.names):
+                first = self._name_index.get(name)
+                if first is None or (not self._defines(first) and self._defines(i)):
+                    self._name_index[name] = i
+        return self._name_index
+
+    def _defines(self, index):
+        # whether the declaration at `index` defines the struct's members, rather than referring to it like
+        # `struct foo;`. work it out without parsing if we haven't already, a reference resolves to a layout with no
+        # members
+        if self._decls is None and self.lazy:
+            return self.header.definition(index) == index
+        if self._decls is None:
+            for layouts in self._layouts.values():
+                return layouts[index] is None or len(layouts[index].members) > 0
+        return self.decls[index].decls is not None
+
+    def decl_named(self, name, kind=c_ast.Struct):
+        """
+        Return the first declaration of the struct `name` that defines its
+        members, or the first reference to it if it's never defined, or None.
+        If `kind` is c_ast.Union, the same goes for the union `name`. Structs
+        declared inside unions are found too, though they aren't in `names`.
+        """
+        if self._decl_index is None:
+            # index definitions ahead of references like `struct foo;` or `struct foo m;`, by kind and name
+            self._decl_index = {}
+            unions = NodeFinder(c_ast.Union).find(self.ast)
+            nested = [d for u in unions for d in NodeFinder(c_ast.Struct).find(u)]
+            for d in self.decls + unions + nested:
+                key = (type(d), d.name)
+                first = self._decl_index.get(key)
+                if first is None or (first.decls is None and d.decls is not None):
+                    self._decl_index[key] = d
+        return self._decl_index.get((kind, name))
 
     def struct_named(self, name):
-        decl = self.decl_named(name);
-        if decl:
-            st = type(name, (Structure,), {'_decl': decl, '_ast': self.ast, '_name': name, '_ss': self})
-        else:
-            st = None
-        return st
+        """
+        Return the Structure subclass for the struct `name`, or None. The same
+        class is returned every time, so layouts resolved for it are reused.
+        """
+        index = self.name_index.get(name)
+        if index is None:
+            return None
+        return self._struct_class(index)
 
     def all_structs(self):
-        return [type(decl.name, (Structure,),
-                    {'_decl': decl, '_ast': self.ast, '_name': decl.name, '_ss': self}) for decl in self.decls]
+        return [self._struct_class(i) for i in range(len(self.names))]
 
+    def _struct_class(self, index):
+        try:
+            return self._classes[index]
+        except KeyError:
+            name = self.names[index]
+            cls = self._classes[index] = type(name or 'Structure', (Structure,),
+                                              {'_name': name, '_index': index, '_ss': self, '__slots__': ()})
+            return cls
@@ -0,0 +1,164 @@
+# tests for the asyncio support, which needs python 3.6 or later. these drive the event loop by hand rather than using
+# async syntax so the module can still be imported (and skipped) on older pythons
+from destructor import *
+from unittest import SkipTest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+STRUCT = """
+struct TestNest {
+    unsigned int        n1;
+    unsigned long long  n2;
+};
+struct Test {
+    char                m_char;
+    int                 m_int;
+    char                m_string[8];
+    struct TestNest     m_nest;
+};
+"""
+
+DATA = (
+    b"\x41"
+    b"\xFF\x00\xFF\x11"
+    b"AAAAAABB"
+    b"\x42\x42\x42\x42"
+    b"\x43\x43\x43\x43\x43\x43\x43\x43"
+)
+
+
+class TestStruct(Structure):
+    _source = STRUCT
+    _name = "Test"
+
+
+class TestNestStruct(Structure):
+    _source = STRUCT
+    _name = "TestNest"
+
+
+def setup_module():
+    global loop
+    if not hasattr(Structure, 'aiter_records'):
+        raise SkipTest
+    loop = asyncio.new_event_loop()
+
+def teardown_module():
+    loop.close()
+
+def assert_raises(exc, func, *args):
+    try:
+        func(*args)
+    except exc:
+        return
+    assert False, "%s not raised" % exc.__name__
+
+def collect(agen):
+    # run an async iterator to completion and return a list of what it yielded
+    items = []
+    while True:
+        try:
+            items.append(loop.run_until_complete(agen.__anext__()))
+        except StopAsyncIteration:
+            return items
+
+def serve(data, chunk=None):
+    # start a local server that sends `data` (in writes of `chunk` bytes) to each client, and return it along with a
+    # reader connected to it
+    def handle(reader, writer):
+        step = chunk or len(data) or 1
+        for i in range(0, len(data), step):
+            writer.write(data[i:i + step])
+        writer.close()
+    server = loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', 0))
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = loop.run_until_complete(asyncio.open_connection('127.0.0.1', port))
+    return server, reader
+
+def receive(records, batch=60):
+    # start a local server that collects what a client sends, write `records` to it and return what it received
+    done = loop.create_future()
+
+    def handle(reader, writer):
+        def finished(future):
+            writer.close()
+            done.set_result(future.result())
+        asyncio.ensure_future(reader.read()).add_done_callback(finished)
+    server = loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', 0))
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = loop.run_until_complete(asyncio.open_connection('127.0.0.1', port))
+    loop.run_until_complete(TestStruct.awrite_many(writer, records, batch=batch))
+    writer.close()
+    data = loop.run_until_complete(done)
+    server.close()
+    return data
+
+# test async record streaming
+
+def test_aiter_records():
+    server, reader = serve(DATA * 10)
+    recs = collect(TestStruct.aiter_records(reader))
+    server.close()
+    assert len(recs) == 10 and all(r.packed == DATA for r in recs)
+
+def test_aiter_records_split():
+    server, reader = serve(DATA * 7, chunk=5)
+    recs = collect(TestStruct.aiter_records(reader, batch=40))
+    server.close()
+    assert [r.m_nest.n2.value for r in recs] == [0x4343434343434343] * 7
+
+def test_aiter_records_lazy():
+    server, reader = serve(DATA * 3)
+    recs = collect(TestStruct.aiter_records(reader, lazy=True))
+    server.close()
+    assert [r.m_int.value for r in recs] == [0x11FF00FF] * 3
+
+def test_aiter_records_view():
+    server, reader = serve(DATA * 3)
+    recs = collect(TestStruct.aiter_records(reader, view=True))
+    server.close()
+    assert [r.m_string.value for r in recs] == [b"AAAAAABB"] * 3
+
+def test_aiter_records_view_writable():
+    server, reader = serve(DATA * 3, chunk=7)
+    recs = collect(TestStruct.aiter_records(reader, batch=2 * len(DATA), view=True))
+    server.close()
+    for i, r in enumerate(recs):
+        r.m_int.value = i
+    assert [r.m_int.value for r in recs] == [0, 1, 2] and recs[2].m_string.value == b"AAAAAABB"
+
+def test_aiter_records_endian():
+    server, reader = serve(DATA * 2)
+    recs = collect(TestStruct.aiter_records(reader, endian=ENDIAN_BIG))
+    server.close()
+    assert [r.m_int.value for r in recs] == [-0xFF00EF] * 2
+
+def test_aiter_records_incomplete():
+    server, reader = serve(DATA * 2 + DATA[:10])
+    agen = TestStruct.aiter_records(reader)
+    loop.run_until_complete(agen.__anext__())
+    loop.run_until_complete(agen.__anext__())
+    assert_raises(ValueError, loop.run_until_complete, agen.__anext__())
+    server.close()
+
+# test async bulk writes
+
+def test_awrite_many():
+    assert receive([TestStruct(DATA)] * 5) == DATA * 5
+
+def test_awrite_many_iterable():
+    s = TestStruct(DATA)
+    assert receive((s for i in range(3)), batch=1) == DATA * 3
+
+def test_awrite_many_async_iterable():
+    server, reader = serve(DATA * 4)
+    data = receive(TestStruct.aiter_records(reader))
+    server.close()
+    assert data == DATA * 4
+
+def test_awrite_many_wrong_size():
+    records = [TestStruct(DATA), TestNestStruct()]
+    assert_raises(ValueError, loop.run_until_complete, TestStruct.awrite_many(None, records))
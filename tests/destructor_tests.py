@@ -1,7 +1,23 @@
 from nose.tools import *
 from destructor import *
 from pycparser import c_parser, c_ast
+import array
+import io
 import os
+import socket
+import shutil
+import tempfile
+from unittest import SkipTest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
 TYPEDEFS = """
 typedef unsigned int        uint32_t;
@@ -138,7 +154,7 @@ class TestStructAnon(Structure):
     _source = ANONSTRUCT
 
 def setup():
-    global s1, s2, s3, s4, s5, s6, s7, s8, s9, ss, s10, s11, sanon
+    global s1, s2, s3, s4, s5, s6, s7, s8, s9, ss, s10, s11, sanon, cache_dir
     s1 = Structure(source=STRUCT)
     s2 = Structure(source=STRUCT, mode=MODE_ILP32)
     s3 = TestStruct()
@@ -176,6 +192,8 @@ def setup():
     sanon = TestStructAnon()
     sanon.parse(ANONDATA)
 
+    cache_dir = tempfile.mkdtemp()
+
 
 def teardown():
     try:
@@ -186,6 +204,7 @@ def teardown():
         os.remove("tests/test2.bin")
     except:
         pass
+    shutil.rmtree(cache_dir, ignore_errors=True)
 
 # basic class tests
 
@@ -200,6 +219,21 @@ def test_resolver():
     t = res.resolve_type(ast.ext[-1].type)
     assert t.type.names == ['unsigned', 'int']
 
+def test_find_node():
+    ast = c_parser.CParser().parse(STRUCT, filename='<none>')
+    assert find_node(ast, c_parser.c_ast.IdentifierType) is NodeFinder(c_parser.c_ast.IdentifierType).find(ast)[0]
+
+def test_resolver_memoized():
+    ast = c_parser.CParser().parse(TYPEDEF_DECL, filename='<none>')
+    res = TypeResolver(ast)
+    t = res.resolve_type(ast.ext[-1].type)
+    assert res.resolve_type(ast.ext[-1].type) is t and res.resolved['UINT32'] is t
+
+def test_resolver_broken_chain():
+    ast = c_parser.CParser().parse("typedef struct foo foo_t;\ntypedef foo_t bar_t;\nbar_t x;", filename='<none>')
+    res = TypeResolver(ast)
+    assert res.name_for_type(res.resolve_type(ast.ext[-1].type)) == 'foo_t'
+
 def test_set():
     s = StructureSet(source=STRUCT)
     assert len(s.decls) == 1
@@ -692,6 +726,636 @@ def test_file_write():
     d = file("tests/test2.bin").read()
     assert d == DATA
 
+# test whole-struct codec
+
+def test_struct_format():
+    assert s4.format == '<cbB?hHiIqQqQfd16sQQII'
+
+def test_struct_format_ilp32_big_endian():
+    assert s6.format == '>cbB?hHiIlLqQfd16sLLII'
+
+def test_struct_codec_shared():
+    assert s4._codec is TestStruct()._codec
+
+def test_struct_packed():
+    assert s4.packed == DATA
+
+def test_struct_pack_into():
+    buf = bytearray(len(DATA) + 4)
+    s4.pack_into(buf, 4)
+    assert str(buf[4:]) == DATA
+
+def test_struct_parse_offset():
+    s = TestStruct()
+    s.parse("XXXX" + DATA, 4)
+    assert str(s) == DATA
+
+def test_nested_format():
+    assert s8.format == '<QIIQII'
+
+def test_nested_packed():
+    assert s8.packed == MULTIDATA
+
+# test layout caching
+
+def test_layout_cached():
+    assert TestStruct()._layout is s4._layout
+
+def test_layout_per_mode():
+    assert TestStruct(mode=MODE_ILP32)._layout is not s4._layout
+
+def test_layout_per_endian():
+    assert s5._layout is not s4._layout
+
+def test_layout_per_class():
+    assert TestStructNest()._layout is not s4._layout
+
+def test_layout_instance_values():
+    s = TestStruct()
+    s.parse(DATA)
+    s.m_int.value = 0
+    assert s4.m_int.value == 0x11FF00FF
+
+def test_layout_nested_instance_values():
+    s = TestStructNest()
+    s.parse(MULTIDATA)
+    s.m_nest.m1.value = 0
+    assert s8.m_nest.m1.value == 0x44444444
+
+def test_layout_members_shared():
+    a, b = TestStruct(DATA), TestStruct(DATA)
+    assert a.m_int._layout is b.m_int._layout and type(a.m_int._layout) == MemberLayout
+    assert not hasattr(a.m_int._layout, '__dict__') and not hasattr(a.m_int, '__dict__')
+    a.m_int.value = 0
+    assert b.m_int.value == 0x11FF00FF
+
+def test_layout_struct_set_slots():
+    # there's no instance __dict__ to put anything else in
+    s = ss.struct_named('Test')(MULTIDATA)
+    assert type(s).__slots__ == ()
+    assert_raises(AttributeError, setattr, s, 'extra', 1)
+    assert_raises(AttributeError, setattr, s.m_nest, 'extra', 1)
+
+def test_member_standalone_value():
+    m = StructureMember(type_name='unsigned int')
+    n = StructureMember(type_name='unsigned int')
+    m.value = 5
+    assert m.value == 5 and n.value is None and m.packed == "\x05\x00\x00\x00"
+    n.value = 6
+    assert m.value == 5 and m._layout is not n._layout
+
+# test layout cache
+
+def test_layout_serialize():
+    layout = StructureLayout.deserialize(s8._layout.serialize())
+    assert layout.format == s8.format
+
+def test_layout_cache_miss():
+    cache = LayoutCache(os.path.join(cache_dir, 'miss'))
+    StructureSet(source=MULTISTRUCT, cache=cache).struct_named('Test')()
+    assert cache.stats['misses'] == 1 and len(os.listdir(cache.path)) == 1
+
+def test_layout_cache_hit():
+    path = os.path.join(cache_dir, 'hit')
+    StructureSet(source=MULTISTRUCT, cache=path).struct_named('Test')()
+    cache = LayoutCache(path)
+    ss = StructureSet(source=MULTISTRUCT, cache=cache)
+    s = ss.struct_named('Test')()
+    s.parse(MULTIDATA)
+    assert ss._parser is None and cache.stats['hits'] == 1
+    assert s.m_nest.m3.n2.value == 0x47474747
+
+def test_layout_cache_mode():
+    cache = LayoutCache(os.path.join(cache_dir, 'mode'))
+    StructureSet(source=MULTISTRUCT, cache=cache).struct_named('Test')()
+    s = StructureSet(source=MULTISTRUCT, cache=cache).struct_named('Test')(mode=MODE_ILP32)
+    assert s.size == 28 and cache.stats['misses'] == 2
+
+def test_layout_cache_subclass():
+    class CachedStruct(Structure):
+        _source = STRUCT
+        _cache = os.path.join(cache_dir, 'subclass')
+    CachedStruct()
+    class CachedStruct(Structure):
+        _source = STRUCT
+        _cache = LayoutCache(os.path.join(cache_dir, 'subclass'))
+    s = CachedStruct(DATA)
+    assert str(s) == DATA and CachedStruct._cache.stats['hits'] == 1
+
+UNSUPPORTED = """
+enum color { RED };
+struct A {
+    int                 a;
+};
+struct B {
+    enum color          c;
+};
+"""
+
+def test_layout_cache_unsupported():
+    # a struct that can't be resolved doesn't stop its siblings from being cached
+    path = os.path.join(cache_dir, 'unsupported')
+    for hits in (0, 1):
+        ss = StructureSet(source=UNSUPPORTED, cache=path)
+        assert ss.struct_named('A')().size == 4 and ss.cache.hits == hits
+        assert ss.names == ['A', 'B']
+        assert_raises(IndexError, ss.struct_named('B'))
+
+def test_layout_cache_version():
+    # entries written by an older version aren't used
+    import destructor.cache
+    cache = LayoutCache(os.path.join(cache_dir, 'version'))
+    version = destructor.cache.CACHE_VERSION
+    destructor.cache.CACHE_VERSION = version - 1
+    try:
+        cache.store(UNION, MODE_LP64, ENDIAN_LITTLE, [('Test', [('m_void_p', 'void *', 1)])])
+    finally:
+        destructor.cache.CACHE_VERSION = version
+    assert cache.load(UNION, MODE_LP64, ENDIAN_LITTLE) is None
+    s = StructureSet(source=UNION, cache=cache).struct_named('Test')()
+    assert s.size == 32 and s.m_nest.m3.format == '<8s'
+
+# test bulk parsing
+
+def test_parse_many_count():
+    cols = TestStruct.parse_many(DATA * 3)
+    assert len(cols['m_int']) == 3
+
+def test_parse_many_columns():
+    cols = TestStruct.parse_many(DATA * 3)
+    assert list(cols.keys())[:3] == ['m_char', 'm_signed_char', 'm_unsigned_char']
+
+def test_parse_many_values():
+    cols = TestStruct.parse_many(DATA * 3)
+    assert list(cols['m_unsigned_int']) == [0x22FF00FF] * 3
+
+def test_parse_many_array_column():
+    cols = TestStruct.parse_many(DATA * 3)
+    assert type(cols['m_unsigned_int']) == array.array
+
+def test_parse_many_string_column():
+    cols = TestStruct.parse_many(DATA * 3)
+    assert cols['m_string'] == ["AAAAAAAAAAAAAABB"] * 3
+
+def test_parse_many_offset_count():
+    cols = TestStruct.parse_many("XX" + DATA * 3, count=2, offset=2)
+    assert len(cols['m_char']) == 2
+
+def test_parse_many_too_many():
+    assert_raises(ValueError, TestStruct.parse_many, DATA, count=2)
+
+def test_parse_many_big_endian():
+    cols = TestStruct.parse_many(DATA * 2, endian=ENDIAN_BIG)
+    assert list(cols['m_unsigned_int']) == [0xFF00FF22] * 2
+
+def test_parse_many_instance():
+    cols = s6.parse_many(DATA)
+    assert list(cols['m_long']) == [-128]
+
+def test_parse_many_nested():
+    cols = TestStructNest.parse_many(MULTIDATA * 2)
+    assert list(cols['m_nest.m3.n2']) == [0x47474747] * 2
+
+def test_parse_many_batches():
+    cols = TestStruct.layout_for().parse_many(DATA * 5, batch=2)
+    assert list(cols['m_UINT32']) == [0x220000] * 5
+
+def test_parse_many_array_member():
+    class ArrayStruct(Structure):
+        _source = "struct A { short m_a[3]; int m_b; };"
+    cols = ArrayStruct.parse_many("\x01\x00\x02\x00\x03\x00\x04\x00\x00\x00" * 2)
+    assert cols['m_a'] == [(1, 2, 3)] * 2
+
+# test numpy support
+
+def test_numpy_dtype_size():
+    if numpy is None:
+        raise SkipTest
+    assert TestStruct.numpy_dtype().itemsize == 100
+
+def test_numpy_dtype_fields():
+    if numpy is None:
+        raise SkipTest
+    dt = TestStruct.numpy_dtype()
+    assert dt.names[:2] == ('m_char', 'm_signed_char') and dt['m_string'] == numpy.dtype('S16')
+
+def test_numpy_dtype_ilp32():
+    if numpy is None:
+        raise SkipTest
+    dt = TestStruct.numpy_dtype(mode=MODE_ILP32)
+    assert dt.itemsize == s2.size == 84 and dt['m_long'] == numpy.dtype('<i4')
+
+def test_numpy_dtype_big_endian():
+    if numpy is None:
+        raise SkipTest
+    assert TestStruct.numpy_dtype(endian=ENDIAN_BIG)['m_unsigned_int'] == numpy.dtype('>u4')
+
+def test_numpy_dtype_nested():
+    if numpy is None:
+        raise SkipTest
+    assert TestStructNest.numpy_dtype()['m_nest']['m3'].itemsize == 8
+
+def test_numpy_dtype_subarray():
+    if numpy is None:
+        raise SkipTest
+    class ArrayStruct(Structure):
+        _source = "struct A { short m_a[3]; int m_b; };"
+    assert ArrayStruct.numpy_dtype()['m_a'].shape == (3,)
+
+def test_numpy_frombuffer():
+    if numpy is None:
+        raise SkipTest
+    a = TestStruct.frombuffer(DATA * 4)
+    assert len(a) == 4 and (a['m_unsigned_int'] == 0x22FF00FF).all()
+
+def test_numpy_frombuffer_nested():
+    if numpy is None:
+        raise SkipTest
+    a = TestStructNest.frombuffer(MULTIDATA * 2)
+    assert (a['m_nest']['m3']['n2'] == 0x47474747).all()
+
+def test_numpy_frombuffer_values():
+    if numpy is None:
+        raise SkipTest
+    a = TestStruct.frombuffer(DATA)
+    assert a['m_double'][0] == s4.m_double.value and a['m_char_p'][0] == s4.m_char_p.value
+
+def test_numpy_memmap():
+    if numpy is None:
+        raise SkipTest
+    a = TestStruct.memmap("tests/test.bin")
+    assert len(a) == 1 and a['m_string'][0] == "AAAAAAAAAAAAAABB"
+
+# test buffer views
+
+def test_view_value():
+    buf = bytearray(DATA)
+    assert TestStruct.view(buf).m_unsigned_int.value == 0x22FF00FF
+
+def test_view_offset():
+    buf = bytearray("XXXX" + DATA)
+    assert TestStruct.view(buf, 4).m_string.value == "AAAAAAAAAAAAAABB"
+
+def test_view_reads_buffer():
+    buf = bytearray(DATA)
+    v = TestStruct.view(buf)
+    buf[8:12] = "\x01\x00\x00\x00"
+    assert v.m_int.value == 1
+
+def test_view_writes_buffer():
+    buf = bytearray(DATA)
+    v = TestStruct.view(buf)
+    v.m_int.value = 2
+    assert buf[8:12] == "\x02\x00\x00\x00"
+
+def test_view_writes_buffer_big_endian():
+    buf = bytearray(DATA)
+    v = TestStruct.view(buf, endian=ENDIAN_BIG)
+    v.m_int.value = 2
+    assert buf[8:12] == "\x00\x00\x00\x02"
+
+def test_view_nested():
+    buf = bytearray(MULTIDATA)
+    v = TestStructNest.view(buf)
+    v.m_nest.m3.n2.value = 1
+    assert buf[28:32] == "\x01\x00\x00\x00" and v.m_nest.m3.n2.value == 1
+
+def test_view_packed():
+    buf = bytearray(DATA)
+    v = TestStruct.view(buf)
+    buf[0] = "B"
+    assert str(v) == "B" + DATA[1:]
+
+def test_view_unbind():
+    buf = bytearray(DATA)
+    v = TestStruct.view(buf)
+    v.unbind()
+    buf[0] = "B"
+    assert str(v) == DATA
+
+def test_view_parse_detaches():
+    buf = bytearray(DATA)
+    v = TestStruct.view(buf)
+    v.m_int.value
+    v.parse(DATA)
+    v.m_int.value = 3
+    assert buf == bytearray(DATA)
+
+# test memory mapped files
+
+def test_mapped_view():
+    with MappedFile("tests/test.bin", readonly=True) as f:
+        assert f.view(TestStruct).m_UINT32.value == 0x220000
+
+def test_mapped_views():
+    shutil.copy("tests/test.bin", "tests/test2.bin")
+    with open("tests/test2.bin", "ab") as f:
+        f.write(DATA)
+    with MappedFile("tests/test2.bin", readonly=True) as f:
+        assert [str(v) for v in f.views(TestStruct)] == [DATA, DATA]
+
+def test_mapped_write_through():
+    shutil.copy("tests/test.bin", "tests/test2.bin")
+    with MappedFile("tests/test2.bin") as f:
+        f.view(TestStruct, 0).m_int.value = 1
+        f.flush(8, 4)
+    assert file("tests/test2.bin").read()[8:12] == "\x01\x00\x00\x00"
+
+def test_mapped_size():
+    if os.path.exists("tests/test2.bin"):
+        os.remove("tests/test2.bin")
+    with MappedFile("tests/test2.bin", size=200) as f:
+        f.view(TestStruct, 100).m_int.value = 1
+    assert os.path.getsize("tests/test2.bin") == 200
+
+def test_mapped_empty():
+    if os.path.exists("tests/test2.bin"):
+        os.remove("tests/test2.bin")
+    assert_raises(ValueError, MappedFile, "tests/test2.bin")
+    assert not os.path.exists("tests/test2.bin")
+    open("tests/test2.bin", "wb").close()
+    assert_raises(ValueError, MappedFile, "tests/test2.bin")
+    assert_raises(ValueError, MappedFile, "tests/test2.bin", readonly=True)
+    os.remove("tests/test2.bin")
+    assert_raises(IOError, MappedFile, "tests/test2.bin", readonly=True)
+
+def test_mapped_readonly():
+    with MappedFile("tests/test.bin", readonly=True) as f:
+        v = f.view(TestStruct)
+        assert_raises(TypeError, setattr, v.m_int, 'value', 1)
+
+def test_mapped_read():
+    s = TestStruct()
+    with MappedFile("tests/test.bin", readonly=True) as f:
+        s.read(f)
+    assert str(s) == DATA
+
+def test_mapped_write():
+    shutil.copy("tests/test.bin", "tests/test2.bin")
+    with MappedFile("tests/test2.bin") as f:
+        s5.write(f)
+    assert file("tests/test2.bin").read() == DATA
+
+# test lazy parsing
+
+def test_lazy_value():
+    s = TestStruct()
+    s.parse(DATA, lazy=True)
+    assert s.m_unsigned_int.value == 0x22FF00FF
+
+def test_lazy_not_decoded():
+    buf = bytearray(DATA)
+    s = TestStruct()
+    s.parse(buf, lazy=True)
+    assert s.m_int.value == 0x11FF00FF
+    offset = s._layout.offsets['m_uint32_t']
+    buf[offset:offset + 4] = "\x01\x00\x00\x00"
+    assert s.m_uint32_t.value == 1 and s.m_int.value == 0x11FF00FF
+
+def test_lazy_cached():
+    buf = bytearray(DATA)
+    s = TestStruct()
+    s.parse(buf, lazy=True)
+    s.m_int.value
+    buf[8:12] = "\x00\x00\x00\x00"
+    assert s.m_int.value == 0x11FF00FF
+
+def test_lazy_offset():
+    s = TestStruct()
+    s.parse("XX" + DATA, 2, lazy=True)
+    assert s.m_string.value == "AAAAAAAAAAAAAABB"
+
+def test_lazy_nested():
+    buf = bytearray(MULTIDATA)
+    s = TestStructNest()
+    s.parse(buf, lazy=True)
+    assert s.m_nest.m3.n2.value == 0x47474747
+    offset = s._layout.offsets['m_nest'] + s.m_nest._layout.offsets['m1']
+    buf[offset:offset + s.m_nest.m1.size] = "\x00" * s.m_nest.m1.size
+    assert s.m_nest.m1.value == 0
+
+def test_lazy_set():
+    s = TestStruct()
+    s.parse(DATA, lazy=True)
+    s.m_int.value = 1
+    assert s.m_int.value == 1
+
+def test_lazy_packed():
+    s = TestStructNest()
+    s.parse(MULTIDATA, lazy=True)
+    s.m_nest.m1.value = 0x41414141
+    assert str(s) == MULTIDATA[:12] + "AAAA" + MULTIDATA[16:]
+
+def test_lazy_then_eager():
+    s = TestStruct()
+    s.parse(DATA, lazy=True)
+    s.parse(DATA.replace("AAAA", "CCCC", 1))
+    assert s.m_string.value == "CCCCAAAAAAAAAABB"
+
+# test parallel parsing
+
+def write_records(n):
+    with open("tests/test2.bin", "wb") as f:
+        f.write(DATA * n)
+
+def sum_m_int(columns):
+    return sum(columns['m_int'])
+
+def test_parse_parallel():
+    if futures is None:
+        raise SkipTest
+    write_records(50)
+    cols = TestStruct.parse_parallel("tests/test2.bin", workers=2, chunk_size=1000)
+    assert cols == TestStruct.parse_many(DATA * 50)
+
+def test_parse_parallel_reduce():
+    if futures is None:
+        raise SkipTest
+    write_records(50)
+    parts = TestStruct.parse_parallel("tests/test2.bin", reduce=sum_m_int, workers=2, chunk_size=1000)
+    assert len(parts) == 5 and sum(parts) == 50 * 0x11FF00FF
+
+def test_parse_parallel_offset_count():
+    if futures is None:
+        raise SkipTest
+    with open("tests/test2.bin", "wb") as f:
+        f.write("XX" + MULTIDATA * 10)
+    cols = TestStructNest.parse_parallel("tests/test2.bin", 3, offset=2, workers=2, chunk_size=32,
+                                         executor=futures.ThreadPoolExecutor(2))
+    assert list(cols['m_nest.m3.n2']) == [0x47474747] * 3
+
+def test_parse_parallel_mapped_file():
+    if futures is None:
+        raise SkipTest
+    write_records(4)
+    with MappedFile("tests/test2.bin", readonly=True) as f:
+        cols = TestStruct.parse_parallel(f, mode=MODE_ILP32, endian=ENDIAN_BIG, workers=1)
+    expected = TestStruct.parse_many(DATA * 4, mode=MODE_ILP32, endian=ENDIAN_BIG)
+    assert cols['m_long'] == expected['m_long'] and cols['m_string'] == expected['m_string'] and len(cols['m_long']) == 4
+
+def test_parse_parallel_too_many():
+    if futures is None:
+        raise SkipTest
+    write_records(2)
+    assert_raises(ValueError, TestStruct.parse_parallel, "tests/test2.bin", 3)
+
+def test_parse_parallel_mmap():
+    if futures is None:
+        raise SkipTest
+    write_records(2)
+    with MappedFile("tests/test2.bin", readonly=True) as f:
+        assert_raises(TypeError, TestStruct.parse_parallel, f.map)
+
+# test record streaming
+
+class ShortReads(object):
+    def __init__(self, data, n):
+        self.f = io.BytesIO(data)
+        self.n = n
+
+    def read(self, size):
+        return self.f.read(min(size, self.n))
+
+def test_iter_records():
+    recs = list(TestStruct.iter_records(io.BytesIO(DATA * 3)))
+    assert len(recs) == 3 and [str(r) for r in recs] == [DATA] * 3
+
+def test_iter_records_boundaries():
+    recs = list(TestStruct.iter_records(io.BytesIO(DATA * 5), chunk_size=150))
+    assert [r.m_UINT32.value for r in recs] == [0x220000] * 5
+
+def test_iter_records_short_reads():
+    recs = list(TestStruct.iter_records(ShortReads(DATA * 3, 33), chunk_size=250))
+    assert [str(r) for r in recs] == [DATA] * 3
+
+def test_iter_records_lazy():
+    recs = list(TestStructNest.iter_records(io.BytesIO(MULTIDATA * 2), lazy=True))
+    assert [r.m_nest.m3.n2.value for r in recs] == [0x47474747] * 2
+
+def test_iter_records_view():
+    recs = list(TestStruct.iter_records(io.BytesIO(DATA * 2), view=True))
+    assert recs[1]._buffer is not None and recs[1].m_string.value == "AAAAAAAAAAAAAABB"
+
+def test_iter_records_view_writable():
+    f = io.BytesIO(DATA * 3)
+    recs = list(TestStruct.iter_records(f, chunk_size=2 * len(DATA), view=True))
+    for i, r in enumerate(recs):
+        r.m_int.value = i
+    assert [r.m_int.value for r in recs] == [0, 1, 2] and recs[2].packed[len(DATA) - 8:] == DATA[len(DATA) - 8:]
+    assert f.getvalue() == DATA * 3
+
+def test_iter_records_endian():
+    recs = list(TestStruct.iter_records(io.BytesIO(DATA), endian=ENDIAN_BIG))
+    assert recs[0].m_int.value == -16711919
+
+def test_iter_records_incomplete():
+    assert_raises(ValueError, list, TestStruct.iter_records(io.BytesIO(DATA + "X")))
+
+def test_iter_records_socket():
+    a, b = socket.socketpair()
+    a.sendall(MULTIDATA * 3)
+    a.close()
+    recs = list(TestStructNest.iter_records(b, chunk_size=40))
+    b.close()
+    assert [str(r) for r in recs] == [MULTIDATA] * 3
+
+# test bulk file I/O
+
+class CountingFile(object):
+    def __init__(self, data=""):
+        self.f = io.BytesIO(data)
+        self.reads = 0
+        self.writes = 0
+
+    def seek(self, offset):
+        self.f.seek(offset)
+
+    def read(self, size):
+        self.reads += 1
+        return self.f.read(size)
+
+    def write(self, data):
+        self.writes += 1
+        self.f.write(data)
+
+def test_read_single_call():
+    f = CountingFile(MULTIDATA)
+    s = TestStructNest()
+    s.read(f)
+    assert f.reads == 1 and str(s) == MULTIDATA
+
+def test_read_offset():
+    s = TestStruct()
+    s.read(io.BytesIO("XXX" + DATA), 3)
+    assert str(s) == DATA
+
+def test_write_single_call():
+    f = CountingFile()
+    s8.write(f)
+    assert f.writes == 1 and f.f.getvalue() == MULTIDATA
+
+def test_write_many():
+    f = CountingFile()
+    TestStruct.write_many(f, [s4, s7, s4])
+    assert f.writes == 1 and f.f.getvalue() == DATA * 3
+
+def test_write_many_generator():
+    f = io.BytesIO()
+    TestStruct.write_many(f, (s4 for i in range(4)))
+    assert f.getvalue() == DATA * 4
+
+def test_write_many_offset():
+    f = io.BytesIO("X" * 10)
+    TestStruct.write_many(f, [s4], offset=5)
+    assert f.getvalue() == "X" * 5 + DATA
+
+def test_write_many_wrong_size():
+    assert_raises(ValueError, TestStruct.write_many, io.BytesIO(), [s4, s2])
+
+def test_write_many_mapped():
+    if os.path.exists("tests/test2.bin"):
+        os.remove("tests/test2.bin")
+    with MappedFile("tests/test2.bin", size=300) as f:
+        TestStruct.write_many(f, [s4, s4], offset=100)
+    assert file("tests/test2.bin").read()[100:] == DATA * 2
+
+# test generated code
+
+def test_generated_source():
+    src = TestStruct.generated_source()
+    assert "def parse(" in src and "def pack(" in src and "def to_dict(" in src
+    assert "m_string @ 60 '<16s'" in src
+
+def test_generated_source_nested():
+    assert "m_nest.m3.n2 @ 28 '<I'" in TestStructNest.generated_source()
+
+def test_generated_traceback():
+    import linecache
+    code = TestStruct.layout_for().code
+    filename = code.parse.__code__.co_filename
+    assert linecache.getline(filename, 2).startswith("def parse(")
+
+def test_to_dict():
+    d = s4.to_dict()
+    assert d['m_int'] == 0x11FF00FF and d['m_string'] == "AAAAAAAAAAAAAABB" and len(d) == 19
+
+def test_to_dict_nested():
+    d = s8.to_dict()
+    assert d['m_nest']['m3']['n2'] == 0x47474747 and d['m_uint32_t'] == 0x43434343
+
+def test_to_dict_view():
+    buf = bytearray(MULTIDATA)
+    v = TestStructNest.view(buf)
+    buf[28:32] = "\x01\x00\x00\x00"
+    assert v.to_dict()['m_nest']['m3']['n2'] == 1
+
+def test_packed_nested_view():
+    s = TestStructNest(MULTIDATA)
+    buf = bytearray(MULTIDATA)
+    s.m_nest.bind(buf, 12)
+    buf[28:32] = "\x01\x00\x00\x00"
+    assert s.packed == MULTIDATA[:28] + "\x01\x00\x00\x00"
+
 # test nested structs
 
 def test_nested_m_void_p():
@@ -738,7 +1402,211 @@ def test_nested_m_nest_m3_n2_value():
 
 # test union
 
+def test_union_size():
+    assert s9.size == 32 and s9.m_nest.size == 20 and s9.m_nest.m3.size == 8 and s9.m_nest.m3.count == 1
+
+def test_union_m_nest_m3():
+    assert type(s9.m_nest.m3) == Structure
+
+def test_union_members_overlap():
+    assert s9.m_nest.m3.n1.value == 0x4747474746464646 and s9.m_nest.m3.n2.value == 0x4747474746464646
+    assert TestNestUnion.offsetof('m_nest.m3.n1') == TestNestUnion.offsetof('m_nest.m3.n2') == 24
+
+def test_union_set():
+    s = TestNestUnion(UNIONDATA)
+    s.m_nest.m3.n1.value = 5
+    assert s.m_nest.m3.n2.value == 5 and s.packed == UNIONDATA[:24] + "\x05" + "\0" * 7
+
+def test_union_parse_copies():
+    buf = bytearray(UNIONDATA)
+    s = TestNestUnion(buf)
+    buf[24:32] = "\0" * 8
+    assert s.m_nest.m3.n1.value == 0x4747474746464646
+
+def test_union_view():
+    buf = bytearray(UNIONDATA)
+    v = TestNestUnion.view(buf)
+    v.m_nest.m3.n2.value = 1
+    assert buf[24:32] == bytearray("\x01" + "\0" * 7) and v.m_nest.m3.n1.value == 1
+    buf[24] = 2
+    assert v.m_nest.m3.n1.value == 2 and v.packed == str(buf)
+
+def test_union_lazy():
+    s = TestNestUnion()
+    s.parse(UNIONDATA, lazy=True)
+    assert s.m_nest.m3.n2.value == 0x4747474746464646 and s.packed == UNIONDATA
+
+def test_union_unset():
+    assert TestNestUnion().m_nest.m3.n1.value == 0
+
+def test_union_to_dict():
+    assert s9.to_dict()['m_nest']['m3'] == {'n1': 0x4747474746464646, 'n2': 0x4747474746464646}
+
+def test_union_serialize():
+    l = TestNestUnion.layout_for()
+    d = StructureLayout.deserialize(l.serialize())
+    assert d.layouts[2].layouts[2].union and d.format == l.format and d.size == 32
+
+TAGGED = """
+struct Addr {
+    unsigned short      port;
+    unsigned int        ip;
+};
+union Value {
+    char                tag[5];
+    unsigned int        word;
+    struct Addr         a;
+};
+struct Msg {
+    unsigned short      kind;
+    union Value         v;
+    union Value         many[2];
+    unsigned short      tail;
+};
+"""
+
+TAGGEDDATA = "".join(chr(i) for i in range(1, 23))
+
+class MsgStruct(Structure):
+    _source = TAGGED
+    _name = "Msg"
+
+def test_union_alternatives():
+    m = MsgStruct(TAGGEDDATA)
+    assert m.size == 22 and m.v.size == 6 and m.tail.value == 0x1615
+    assert m.v.word.value == 0x06050403 and m.v.a.port.value == 0x0403 and m.v.a.ip.value == 0x08070605
+    assert m.v.tag.value == "\x03\x04\x05\x06\x07"
+
+def test_union_nested_set():
+    m = MsgStruct(TAGGEDDATA)
+    m.v.a.ip.value = 0
+    assert m.v.word.value == 0x0403 and m.packed == TAGGEDDATA[:4] + "\0" * 4 + TAGGEDDATA[8:]
+
+def test_union_array():
+    m = MsgStruct(TAGGEDDATA)
+    assert m.many[1].word.value == 0x1211100f and m.many.column('a.port') == [0x0a09, 0x100f]
+    m.many[0].word.value = 1
+    assert m.many.column('word') == [1, 0x1211100f] and m.packed[8:12] == "\x01\0\0\0"
+
+def test_union_array_view():
+    buf = bytearray(TAGGEDDATA)
+    v = MsgStruct.view(buf)
+    v.many[1].a.port.value = 0
+    assert buf[14:16] == bytearray("\0\0") and v.many.column('word') == [0x0c0b0a09, 0x12110000]
+
+def test_union_array_unset():
+    m = MsgStruct()
+    m.kind.value = m.tail.value = 0
+    assert m.packed == "\0" * 22
+
+def test_union_unset_alternatives():
+    # a union that was never parsed still shares its bytes between its alternatives
+    source = """
+    struct P { unsigned short port; unsigned short pad; };
+    struct Msg { union { struct P a; unsigned int word; struct P ps[1]; } v; };
+    """
+    m = StructureSet(source).struct_named('Msg')()
+    assert m.v.a.port.value == 0
+    m.v.a.port.value = 5
+    m.v.ps[0].pad.value = 1
+    assert m.v.word.value == 0x00010005 and m.packed == "\x05\x00\x01\x00"
+    m.v.word.value = 7
+    assert m.v.a.port.value == 7 and m.v.ps[0].pad.value == 0 and m.to_dict()['v']['a'] == {'port': 7, 'pad': 0}
+
+UNIONTABLE = """
+struct E {
+    union {
+        unsigned int    i;
+        unsigned short  s;
+    }                   u;
+    unsigned char       c;
+};
+struct A {
+    struct E            items[3];
+};
+"""
 
+def test_union_in_struct_array_column():
+    A = StructureSet(UNIONTABLE).struct_named('A')
+    data = "".join(chr(i) for i in range(1, 16))
+    lazy = A()
+    lazy.parse(data, lazy=True)
+    for a in (A(data), A.view(bytearray(data)), lazy):
+        assert a.items.column('u.i') == [0x04030201, 0x09080706, 0x0e0d0c0b]
+        assert a.items.column('u.s') == [0x0201, 0x0706, 0x0c0b] and a.items.column('c') == [5, 10, 15]
+        assert_raises(TypeError, a.items.column, 'u')
+    a = A(data)
+    a.items[1].u.s.value = 0
+    assert a.items.column('u.i') == [0x04030201, 0x09080000, 0x0e0d0c0b]
+
+def test_union_aligned():
+    # unions are as big as their biggest member, rounded up to their alignment
+    for mode in (MODE_ILP32_ALIGNED, MODE_LP64_ALIGNED):
+        m = MsgStruct(mode=mode)
+        assert m.size == 32 and m.v.size == 8
+        assert [m.offsetof(p) for p in ('v', 'v.a.ip', 'many[1]', 'many[1].word', 'tail')] == [4, 8, 20, 20, 28]
+
+def test_union_aligned_parse():
+    s = TestNestUnion(mode=MODE_LP64_ALIGNED)
+    assert s.size == 40 and s.offsetof('m_nest.m3') == 32
+    data = "".join(chr(i) for i in range(40))
+    s.parse(data)
+    assert s.m_nest.m3.n1.value == 0x2726252423222120 and s.packed[32:] == data[32:]
+
+def test_union_parse_many():
+    cols = MsgStruct.parse_many(TAGGEDDATA * 3)
+    assert list(cols.keys()) == ['kind', 'v', 'many[0]', 'many[1]', 'tail'] and cols['v'] == [TAGGEDDATA[2:8]] * 3
+
+def test_union_scan():
+    assert list(MsgStruct.scan(TAGGEDDATA * 2, ['v.a.ip', 'tail'])) == [(0x08070605, 0x1615)] * 2
+
+def test_union_scan_alternatives():
+    # alternatives share their bytes, which are unpacked once and decoded by each of them
+    rows = list(MsgStruct.scan(TAGGEDDATA * 2, ['tail', 'v.a.port', 'v.word', 'v.tag', 'v.a.ip']))
+    assert rows == [(0x1615, 0x0403, 0x06050403, "\x03\x04\x05\x06\x07", 0x08070605)] * 2
+    cols = MsgStruct.scan_columns(TAGGEDDATA * 2, ['v.word', 'kind', 'v.a.port'])
+    assert list(cols['v.word']) == [0x06050403] * 2 and list(cols['v.a.port']) == [0x0403] * 2
+    assert list(cols['kind']) == [0x0201] * 2
+
+def test_union_filter():
+    data = "\0" * 22 + TAGGEDDATA + "\0" * 22
+    for vectorize in (False, True):
+        if vectorize and numpy is None:
+            raise SkipTest
+        found = list(MsgStruct.filter(data, {'v.word': 0x06050403, 'v.a.port': 0x0403}, vectorize=vectorize))
+        assert [m.tail.value for m in found] == [0x1615]
+
+def test_union_struct_set():
+    assert StructureSet(TAGGED).names == ['Addr', 'Msg']
+    ss = StructureSet(TAGGED, lazy=True)
+    assert ss.names == ['Addr', 'Msg'] and ss.struct_named('Msg')(TAGGEDDATA).v.a.ip.value == 0x08070605
+
+def test_union_decl_named():
+    s = StructureSet(source="union Value;\n" + TAGGED)
+    assert s.decl_named('Value', c_ast.Union).decls is not None and s.decl_named('Value') is None
+    assert s.decl_named('Addr').decls is not None and s.struct_named('Msg')(TAGGEDDATA).v.word.value == 0x06050403
+
+def test_union_struct_declared_inside():
+    # structs declared inside a union can be used elsewhere, but aren't listed in the set
+    source = "union U { struct S { int a; short b; } s; int i; };\nstruct T { struct S x; int y; };"
+    for lazy in (False, True):
+        s = StructureSet(source, lazy=lazy)
+        assert s.names == ['T'] and s.struct_named('T')().size == 10
+
+def test_struct_set_undeclared():
+    assert_raises(NameError, StructureSet("struct T { struct Q q; int y; };").struct_named('T'))
+
+def test_union_peek():
+    assert MsgStruct.peek(TAGGEDDATA, 'v.a.ip') == 0x08070605
+    assert MsgStruct.peek(TAGGEDDATA, 'v').word.value == 0x06050403
+
+def test_union_numpy_dtype():
+    if numpy is None:
+        raise SkipTest
+    dt = MsgStruct.numpy_dtype()
+    assert dt.itemsize == 22 and dt['v'].itemsize == 6 and dt['v'].fields['word'][1] == dt['v'].fields['a'][1] == 0
+    a = numpy.frombuffer(TAGGEDDATA, dtype=dt)
+    assert a['v']['word'][0] == 0x06050403 and a['v']['a']['port'][0] == 0x0403
 
 # test structure set
 
@@ -754,6 +1622,41 @@ def test_struct_set_decl_named():
 def test_struct_set_struct_named():
     assert ss.struct_named('Test').__name__ == 'Test'
 
+def test_struct_set_struct_named_same_class():
+    assert ss.struct_named('Test') is ss.struct_named('Test')
+
+def test_struct_set_all_structs_same_class():
+    assert ss.all_structs()[1] is ss.struct_named('Test')
+
+def test_struct_set_struct_named_missing():
+    assert ss.struct_named('Nope') is None
+
+def test_struct_set_layout_reused():
+    assert ss.struct_named('Test')()._layout is ss.struct_named('Test')()._layout
+
+def test_struct_set_decl_named_definition():
+    s = StructureSet(source="struct TestNest;\n" + MULTISTRUCT)
+    assert s.decl_named('TestNest').decls is not None
+    assert s.struct_named('Test')(MULTIDATA).m_nest.m3.n2.value == 0x47474747
+
+def test_struct_set_forward_declaration():
+    s = StructureSet(source="struct TestNest;\n" + MULTISTRUCT)
+    assert s.names == ['TestNest', 'TestNest', 'Test'] and s.index_of('TestNest') == 1
+    assert s.struct_named('TestNest')().size == 20
+
+def test_struct_set_forward_declaration_class():
+    class ForwardStruct(Structure):
+        _source = "struct TestNest;\n" + MULTISTRUCT
+        _name = "TestNest"
+    assert ForwardStruct().size == 20
+
+def test_struct_set_forward_declaration_cache():
+    path = os.path.join(cache_dir, 'forward')
+    for hits in (0, 1):
+        s = StructureSet(source="struct TestNest;\n" + MULTISTRUCT, cache=path)
+        assert s.struct_named('TestNest')().size == 20 and s.cache.hits == hits
+    assert s._ast is None
+
 def test_struct_set_m_void_p():
     assert str(s10.m_void_p) == "BBBBBBBB"
 
@@ -843,3 +1746,577 @@ def test_struct_set_all_structs_m_nest_m3_n2_value():
     assert s11.m_nest.m3.n2.value == 0x47474747
 
 
+# test lazy structure set
+
+LAZY = """
+typedef unsigned int uint32_t;
+typedef unsigned long long uint64_t;
+typedef uint32_t UINT32;
+enum { A, B };
+struct Unused {
+    uint64_t            u;
+};
+""" + MULTISTRUCT.replace(TYPEDEFS, "") + """
+int f(int x) { return x; }
+struct Other {
+    UINT32              o;
+};
+"""
+
+def test_header_index_names():
+    assert HeaderIndex(LAZY).names == StructureSet(source=LAZY).names
+
+def test_header_index_defs():
+    h = HeaderIndex(LAZY)
+    assert ('ident', 'UINT32') in h.defs and ('ident', 'B') in h.defs and ('struct', 'TestNest') in h.defs
+
+def test_header_index_closure():
+    h = HeaderIndex(LAZY)
+    text = h.text(h.closure(h.structs[h.struct_defs['Test']][0]))
+    assert "struct TestNest" in text and "uint64_t;" in text and "Unused" not in text and "Other" not in text
+
+def test_lazy_set_not_parsed():
+    s = StructureSet(source=LAZY, lazy=True)
+    s.struct_named('Test')
+    assert s._ast is None
+
+def test_lazy_set_struct_named():
+    s = StructureSet(source=LAZY, lazy=True).struct_named('Test')(MULTIDATA)
+    assert s.size == 32 and s.m_nest.m3.n2.value == 0x47474747
+
+def test_lazy_set_typedef_chain():
+    s = StructureSet(source=LAZY, lazy=True).struct_named('Other')("\x01\x00\x00\x00")
+    assert s.o.value == 1
+
+def test_lazy_set_layouts_match():
+    eager = StructureSet(source=LAZY)
+    lazy = StructureSet(source=LAZY, lazy=True)
+    for i in range(len(eager.names)):
+        assert eager.layout(i, MODE_ILP32, ENDIAN_BIG).serialize() == lazy.layout(i, MODE_ILP32, ENDIAN_BIG).serialize()
+
+def test_lazy_set_subset_shared():
+    s = StructureSet(source=LAZY, lazy=True)
+    assert s.subset(s.index_of('Test'))[0] is s.subset(s.index_of('Test'))[0]
+
+def test_lazy_set_forward_declaration():
+    s = StructureSet(source="struct TestNest;\n" + MULTISTRUCT, lazy=True)
+    assert s.struct_named('TestNest')().size == 20
+
+def test_lazy_set_cache():
+    s = StructureSet(source=LAZY, lazy=True, cache=cache_dir).struct_named('Test')(MULTIDATA)
+    s = StructureSet(source=LAZY, lazy=True, cache=cache_dir).struct_named('Test')(MULTIDATA)
+    assert s.m_nest.m1.value == 0x44444444
+
+# test parallel compilation
+
+def test_compile_many():
+    if futures is None:
+        raise SkipTest
+    with open("tests/test2.bin", "w") as f:
+        f.write(MULTISTRUCT)
+    sets = StructureSet.compile_many(filenames=["tests/test2.bin"], sources=[STRUCT, MULTISTRUCT], workers=2)
+    assert [s.names for s in sets] == [['TestNest', 'Test'], ['Test'], ['TestNest', 'Test']]
+    assert sets[0]._ast is None
+    assert sets[2].struct_named('Test')(MULTIDATA).m_nest.m3.n2.value == 0x47474747
+
+def test_compile_many_serialized():
+    if futures is None:
+        raise SkipTest
+    layouts = StructureSet.compile_many(sources=[MULTISTRUCT], mode=MODE_ILP32, endian=ENDIAN_BIG, serialized=True,
+                                        executor=futures.ThreadPoolExecutor(1))
+    assert layouts == [[l.serialize() for l in (ss.layout(0), ss.layout(1))]]
+
+def test_compile_many_cache():
+    if futures is None:
+        raise SkipTest
+    cache = LayoutCache(os.path.join(cache_dir, "many"))
+    StructureSet.compile_many(sources=[MULTISTRUCT], cache=cache, executor=futures.ThreadPoolExecutor(1))
+    s = StructureSet(source=MULTISTRUCT, cache=cache)
+    assert s.struct_named('Test')().size == 32 and cache.hits == 1 and s._ast is None
+
+def test_compile_many_unsupported():
+    if futures is None:
+        raise SkipTest
+    cache = LayoutCache(os.path.join(cache_dir, "many-unsupported"))
+    ss, = StructureSet.compile_many(sources=[UNSUPPORTED], cache=cache, executor=futures.ThreadPoolExecutor(1))
+    assert ss.names == ['A', 'B'] and ss.struct_named('A')().size == 4 and ss._ast is None
+    assert_raises(IndexError, ss.struct_named('B'))
+    assert StructureSet(source=UNSUPPORTED, cache=cache).struct_named('A')().size == 4 and cache.hits == 1
+
+# test profiling
+
+def profiled(func):
+    # run func with profiling enabled and return a snapshot of the counters
+    reset_profiling()
+    enable_profiling()
+    try:
+        func()
+    finally:
+        disable_profiling()
+    return profile_snapshot()
+
+def test_profiling_disabled():
+    parse = Structure.__dict__['parse']
+    enable_profiling()
+    assert profiling_enabled() and Structure.__dict__['parse'] is not parse
+    disable_profiling()
+    assert not profiling_enabled() and Structure.__dict__['parse'] is parse
+    reset_profiling()
+    TestStruct(DATA).packed
+    assert profile_snapshot() == {'enabled': False, 'classes': {}, 'phases': {}}
+
+def test_profiling_parse_pack():
+    def run():
+        s = TestStruct(DATA)
+        s.packed
+        s.pack_into(bytearray(s.size))
+    c = profiled(run)['classes']['TestStruct']
+    assert c['parses'] == 1 and c['packs'] == 2 and c['bytes'] == 3 * len(DATA)
+    assert c['time']['parse'] > 0 and c['time']['pack'] > 0
+
+def test_profiling_read_write():
+    def run():
+        f = io.BytesIO()
+        s = TestStruct(DATA)
+        s.write(f)
+        s.write(f, len(DATA))
+        s.read(f, len(DATA))
+    c = profiled(run)['classes']['TestStruct']
+    assert c['reads'] == 1 and c['writes'] == 2 and c['parses'] == 2 and c['packs'] == 2
+    assert c['time']['read'] > 0 and c['time']['write'] > 0
+
+def test_profiling_bulk():
+    def run():
+        f = io.BytesIO()
+        TestStruct.write_many(f, (TestStruct(DATA) for i in range(3)))
+        list(TestStruct.iter_records(io.BytesIO(f.getvalue())))
+        list(TestStruct.iter_records(io.BytesIO(f.getvalue()), lazy=True))
+        TestStruct.parse_many(f.getvalue())
+    c = profiled(run)['classes']['TestStruct']
+    assert c['writes'] == 3 and c['reads'] == 6 and c['parses'] == 3 + 3 + 3 + 3 and c['packs'] == 3
+
+def test_profiling_filter():
+    data = "\0" * 22 + TAGGEDDATA + "\0" * 22
+    c = profiled(lambda: list(MsgStruct.filter(data, {'kind': 0x0201})))['classes']['MsgStruct']
+    assert c['parses'] == 1 and c['bytes'] == 22 and c['scans'] == 0 and c['time']['scan'] > 0
+
+def test_profiling_scan():
+    def run():
+        list(MsgStruct.scan(TAGGEDDATA * 3, ['tail']))
+        MsgStruct.scan_columns(TAGGEDDATA * 2, ['kind', 'v.word'])
+        MsgStruct.peek(TAGGEDDATA, 'v.word')
+    c = profiled(run)['classes']['MsgStruct']
+    assert c['scans'] == 3 + 2 + 1 and c['bytes'] == 5 * 22 + 4 and c['parses'] == 0 and c['time']['scan'] > 0
+
+def test_profiling_same_name():
+    a = StructureSet(MULTISTRUCT).struct_named('Test')
+    b = StructureSet(MULTISTRUCT).struct_named('Test')
+    size = a().size
+    c = profiled(lambda: (a("\0" * size), b("\0" * size), b("\0" * size)))['classes']
+    assert c['Test']['parses'] == 1 and c['Test#2']['parses'] == 2
+
+def test_profiling_structure_instances():
+    m = MsgStruct(TAGGEDDATA)
+    def run():
+        Structure(source=STRUCT, binary=DATA)
+        m.v.parse(TAGGEDDATA[2:8])
+        m.v.a.packed
+    c = profiled(run)['classes']
+    assert sorted(c) == ['struct Addr', 'struct Test', 'union Value']
+    assert c['struct Test']['parses'] == 1 and c['union Value']['parses'] == 1 and c['struct Addr']['packs'] == 1
+
+def test_profiling_exception():
+    def run():
+        assert_raises(NameError, MsgStruct.peek, TAGGEDDATA, 'nope')
+    c = profiled(run)['classes']['MsgStruct']
+    assert c['scans'] == 0 and c['bytes'] == 0 and c['time']['scan'] > 0
+
+def test_profiling_phases():
+    p = profiled(lambda: StructureSet(MULTISTRUCT).struct_named('Test')())['phases']
+
+    # Test, its nested TestNest and the anonymous struct in that
+    assert p['parse_source']['count'] == 1 and p['parse_decl']['count'] == 3
+    assert p['parse_source']['time'] > 0 and p['parse_decl']['time'] > 0
+
+def test_profiling_snapshot_copy():
+    snap = profiled(lambda: TestStruct(DATA))
+    snap['classes']['TestStruct']['parses'] = 100
+    assert profile_snapshot()['classes']['TestStruct']['parses'] == 1
+
+# test offsets and alignment
+
+ALIGNED = """
+struct Hdr {
+    char                c;
+    int                 length;
+};
+struct Pkt {
+    char                tag;
+    struct Hdr          hdr;
+    double              d;
+    short               s;
+    long                l;
+    char                name[3];
+    unsigned long long  q;
+    void *              p;
+};
+"""
+
+class PktStruct(Structure):
+    _source = ALIGNED
+    _name = "Pkt"
+
+def test_offsetof():
+    assert [offsetof(PktStruct, p) for p in ('tag', 'hdr', 'hdr.c', 'hdr.length', 'd', 's', 'q')] == \
+        [0, 1, 1, 2, 6, 14, 27]
+
+def test_offsetof_instance():
+    s = TestStructNest()
+    assert s.offsetof('m_nest.m3.n2') == 8 + 4 + 4 + 8 + 4 and offsetof(s, 'm_nest') == 12
+
+def test_offsetof_missing():
+    assert_raises(NameError, PktStruct.offsetof, 'hdr.nope')
+
+def test_offsetof_aligned_lp64():
+    # matches gcc on x86-64
+    offsets = [PktStruct.offsetof(p, mode=MODE_LP64_ALIGNED) for p in ('hdr', 'hdr.length', 'd', 's', 'l', 'name', 'q',
+                                                                        'p')]
+    assert offsets == [4, 8, 16, 24, 32, 40, 48, 56]
+    assert PktStruct(mode=MODE_LP64_ALIGNED).size == 64
+
+def test_offsetof_aligned_ilp32():
+    # 8 byte types are only aligned to 4 on i386
+    offsets = [PktStruct.offsetof(p, mode=MODE_ILP32_ALIGNED) for p in ('hdr', 'hdr.length', 'd', 's', 'l', 'name',
+                                                                         'q', 'p')]
+    assert offsets == [4, 8, 12, 20, 24, 28, 32, 40]
+    assert PktStruct(mode=MODE_ILP32_ALIGNED).size == 44
+
+def test_aligned_trailing_padding():
+    s = StructureSet("struct t { int i; char c; };").struct_named('t')(mode=MODE_LP64_ALIGNED)
+    assert s.size == 8 and s.format == '<ic3x'
+
+def test_aligned_parse_pack():
+    s = PktStruct(mode=MODE_LP64_ALIGNED)
+    data = "".join(chr(i) for i in range(s.size))
+    s.parse(data)
+    assert s.hdr.length.value == 0x0b0a0908 and s.s.value == 0x1918 and s.name.value == "()*"
+    packed = s.packed
+    for i in range(len(data)):
+        if packed[i] != "\0":
+            assert packed[i] == data[i]
+    assert PktStruct(packed, mode=MODE_LP64_ALIGNED).to_dict() == s.to_dict()
+
+def test_aligned_view():
+    buf = bytearray(PktStruct(mode=MODE_ILP32_ALIGNED).size)
+    v = PktStruct.view(buf, mode=MODE_ILP32_ALIGNED)
+    v.hdr.length.value = 0x01020304
+    v.q.value = 5
+    assert buf[8:12] == bytearray("\x04\x03\x02\x01") and buf[32] == 5
+    assert PktStruct(str(buf), mode=MODE_ILP32_ALIGNED).hdr.length.value == 0x01020304
+
+def test_aligned_parse_many():
+    s = PktStruct("\0" * 64, mode=MODE_LP64_ALIGNED)
+    s.d.value = 1.5
+    s.p.value = 7
+    cols = PktStruct.parse_many(s.packed * 3, mode=MODE_LP64_ALIGNED)
+    assert list(cols['d']) == [1.5] * 3 and list(cols['p']) == [7] * 3
+
+def test_aligned_serialize():
+    l = PktStruct.layout_for(MODE_ILP32_ALIGNED, ENDIAN_BIG)
+    d = StructureLayout.deserialize(l.serialize(), MODE_ILP32_ALIGNED, ENDIAN_BIG)
+    assert d.format == l.format and d.size == 44
+    assert [d.offsetof(p) for p in sorted(d.paths)] == [l.offsetof(p) for p in sorted(l.paths)]
+
+def test_aligned_cache():
+    StructureSet(source=ALIGNED, cache=cache_dir, mode=MODE_LP64_ALIGNED).layout(1, MODE_LP64_ALIGNED)
+    s = StructureSet(source=ALIGNED, cache=cache_dir, mode=MODE_LP64_ALIGNED)
+    assert s.layout(1, MODE_LP64_ALIGNED).size == 64 and s._ast is None
+
+def test_aligned_numpy_dtype():
+    if numpy is None:
+        raise SkipTest
+    dt = PktStruct.numpy_dtype(mode=MODE_LP64_ALIGNED)
+    assert dt.itemsize == 64 and dt.fields['d'][1] == 16 and dt['hdr'].fields['length'][1] == 4
+
+def test_peek():
+    assert TestStruct.peek(DATA, 'm_int') == TestStruct(DATA).m_int.value
+    assert TestStructNest.peek(MULTIDATA, 'm_nest.m3.n2') == 0x47474747
+
+def test_peek_offset():
+    assert TestStructNest.peek("\0" * 5 + MULTIDATA * 2, 'm_nest.m1', 5 + len(MULTIDATA)) == 0x44444444
+
+def test_peek_nested():
+    n = TestStructNest.peek(MULTIDATA, 'm_nest')
+    assert n.m3.n2.value == 0x47474747 and n.size == 20
+
+def test_peek_aligned():
+    s = PktStruct("\0" * 64, mode=MODE_LP64_ALIGNED)
+    s.hdr.length.value = 1234
+    assert PktStruct.peek(s.packed, 'hdr.length', mode=MODE_LP64_ALIGNED) == 1234
+
+def test_peek_mapped():
+    with open("tests/test2.bin", "wb") as f:
+        f.write(MULTIDATA * 2)
+    with MappedFile("tests/test2.bin") as m:
+        assert TestStructNest.peek(m, 'm_uint32_t', len(MULTIDATA)) == TestStructNest(MULTIDATA).m_uint32_t.value
+
+# test projection
+
+def test_scan():
+    rows = list(TestStruct.scan(DATA * 3, ['m_int', 'm_string']))
+    assert rows == [(0x11FF00FF, "AAAAAAAAAAAAAABB")] * 3
+
+def test_scan_order():
+    rows = list(TestStructNest.scan(MULTIDATA * 2, ['m_nest.m3.n2', 'm_uint32_t']))
+    assert rows == [(0x47474747, 0x43434343)] * 2
+
+def test_scan_skips():
+    codec, convert, members = TestStruct.layout_for().projection(['m_unsigned_int', 'm_UINT32'])
+    assert codec.format == '<12xI80xI' and codec.size == len(DATA) and convert is None
+    assert [i for p, m, i in members] == [0, 1]
+
+def test_scan_array_member():
+    class ArrayStruct(Structure):
+        _source = "struct A { short m_a[3]; int m_b; };"
+    rows = list(ArrayStruct.scan("\x01\x00\x02\x00\x03\x00\x04\x00\x00\x00" * 2, ['m_b', 'm_a']))
+    assert rows == [(4, [1, 2, 3])] * 2
+
+def test_scan_offset_count():
+    rows = list(TestStruct.scan("XX" + DATA * 3, ['m_char'], count=2, offset=2))
+    assert rows == [("A",)] * 2
+    assert_raises(ValueError, TestStruct.scan, DATA, ['m_char'], count=2)
+
+def test_scan_file():
+    f = io.BytesIO("XX" + DATA * 5)
+    rows = list(TestStruct.scan(f, ['m_UINT32'], offset=2, chunk_size=150))
+    assert rows == [(0x220000,)] * 5
+
+def test_scan_mapped():
+    with open("tests/test2.bin", "wb") as f:
+        f.write(MULTIDATA * 3)
+    with MappedFile("tests/test2.bin") as m:
+        assert list(TestStructNest.scan(m, ['m_nest.m1'], count=2)) == [(0x44444444,)] * 2
+
+def test_scan_aligned():
+    s = PktStruct("\0" * 64, mode=MODE_LP64_ALIGNED)
+    s.d.value = 2.5
+    s.hdr.length.value = 9
+    assert list(PktStruct.scan(s.packed * 2, ['d', 'hdr.length'], mode=MODE_LP64_ALIGNED)) == [(2.5, 9)] * 2
+
+def test_scan_bad_fields():
+    assert_raises(TypeError, TestStructNest.scan, MULTIDATA, ['m_nest'])
+    assert_raises(ValueError, TestStruct.scan, DATA, ['m_int', 'm_int'])
+    assert_raises(ValueError, TestStruct.scan, DATA, [])
+    assert_raises(NameError, TestStruct.scan, DATA, ['m_nope'])
+
+def test_scan_columns():
+    cols = TestStructNest.scan_columns(MULTIDATA * 3, ['m_nest.m3.n2', 'm_void_p'])
+    assert list(cols.keys()) == ['m_nest.m3.n2', 'm_void_p'] and type(cols['m_nest.m3.n2']) == array.array
+    assert list(cols['m_nest.m3.n2']) == [0x47474747] * 3
+
+def test_scan_columns_match_parse_many():
+    cols = TestStruct.scan_columns(DATA * 5, ['m_string', 'm_long', 'm_float'], batch=2)
+    full = TestStruct.parse_many(DATA * 5)
+    assert all(list(cols[k]) == list(full[k]) for k in cols)
+
+# test filtering
+
+FILTER = """
+struct Event {
+    unsigned int        ts;
+    unsigned short      type;
+    unsigned char       flags;
+    char                name[5];
+    double              value;
+};
+"""
+
+class EventStruct(Structure):
+    _source = FILTER
+
+def events(n=50):
+    # n events with ts 0..n-1, type ts % 5, flags ts % 8, name "e" + ts and value ts / 2.0
+    data = ""
+    for i in range(n):
+        e = EventStruct("\0" * 20)
+        e.ts.value, e.type.value, e.flags.value, e.name.value, e.value.value = i, i % 5, i % 8, "e%d" % i, i / 2.0
+        data += e.packed
+    return data
+
+def filtered(where, source=None, **kwargs):
+    # the ts of each matching event with and without numpy, which must agree
+    source = source or events()
+    results = [[e.ts.value for e in EventStruct.filter(source, where, vectorize=False, **kwargs)]]
+    if numpy is not None:
+        results.append([e.ts.value for e in EventStruct.filter(source, where, vectorize=True, **kwargs)])
+    assert all(r == results[0] for r in results)
+    return results[0]
+
+def test_filter_equal():
+    assert filtered({'type': 3}) == range(3, 50, 5)
+    assert filtered({'type': Equal(3), 'flags': 3}) == [3, 43]
+
+def test_filter_range():
+    assert filtered({'ts': Range(10, 14)}) == [10, 11, 12, 13]
+    assert filtered({'value': Range(high=1.5)}) == [0, 1, 2]
+    assert filtered({'ts': Range(low=47)}) == [47, 48, 49]
+
+def test_filter_bitmask():
+    assert filtered({'flags': BitMask(6)}) == [i for i in range(50) if i % 8 in (6, 7)]
+    assert filtered({'flags': BitMask(5, 1), 'ts': Range(high=20)}) == [1, 3, 9, 11, 17, 19]
+
+def test_filter_one_of():
+    assert filtered({'ts': OneOf([1, 7, 60])}) == [1, 7]
+    assert filtered({'name': OneOf(["e2", "e12"])}) == [2, 12]
+
+def test_filter_string():
+    assert filtered({'name': "e42"}) == [42]
+
+def test_filter_builds_matches():
+    e = list(EventStruct.filter(events(), {'ts': 7}))[0]
+    assert e.to_dict() == {'ts': 7, 'type': 2, 'flags': 7, 'name': "e7\0\0\0", 'value': 3.5}
+
+def test_filter_chunks():
+    assert filtered({'type': 0}, chunk_size=60) == range(0, 50, 5)
+
+def test_filter_offset_count():
+    assert filtered({'type': 0}, source="XX" + events(), offset=2, count=20) == [0, 5, 10, 15]
+
+def test_filter_file():
+    f = io.BytesIO(events())
+    assert [e.ts.value for e in EventStruct.filter(f, {'ts': Range(40, 42)}, chunk_size=100)] == [40, 41]
+
+def test_filter_mapped():
+    with open("tests/test2.bin", "wb") as f:
+        f.write(events())
+    with MappedFile("tests/test2.bin") as m:
+        assert filtered({'type': 4, 'flags': BitMask(1)}, source=m) == [9, 19, 29, 39, 49]
+
+def test_filter_big_endian():
+    e = EventStruct("\0" * 20, endian=ENDIAN_BIG)
+    e.ts.value = 0x01020304
+    e.flags.value = 0x80
+    assert filtered({'ts': 0x01020304, 'flags': BitMask(0x80)}, source=e.packed * 2, endian=ENDIAN_BIG) == \
+        [0x01020304] * 2
+
+def test_filter_bad_predicates():
+    assert_raises(ValueError, list, EventStruct.filter(events(), {}))
+    assert_raises(NameError, list, EventStruct.filter(events(), {'nope': 1}))
+    assert_raises(TypeError, list, TestStructNest.filter(MULTIDATA, {'m_nest': 1}))
+
+# test arrays of structs
+
+TABLE = """
+struct Entry {
+    unsigned int        id;
+    short               kind;
+    char                name[6];
+};
+struct Table {
+    unsigned int        n;
+    struct Entry        items[4];
+    struct {
+        int             a;
+        char            b;
+    }                   pairs[2];
+    unsigned short      tail;
+};
+"""
+
+TABLEDATA = (
+    "\x04\x00\x00\x00"
+    "\x00\x00\x00\x00" "\x00\x00" "n0\0\0\0\0"
+    "\x01\x00\x00\x00" "\xff\xff" "n1\0\0\0\0"
+    "\x02\x00\x00\x00" "\xfe\xff" "n2\0\0\0\0"
+    "\x03\x00\x00\x00" "\xfd\xff" "n3\0\0\0\0"
+    "\x01\x00\x00\x00" "x"
+    "\x02\x00\x00\x00" "y"
+    "\x07\x00"
+)
+
+class TableStruct(Structure):
+    _source = TABLE
+    _name = "Table"
+
+def test_struct_array():
+    t = TableStruct(TABLEDATA)
+    assert t.size == len(TABLEDATA) and len(t.items) == 4 and t.tail.value == 7
+    assert t.items[2].name.value == "n2\0\0\0\0" and t.items[-1].kind.value == -3 and t.pairs[1].b.value == "y"
+    assert [e.id.value for e in t.items] == [0, 1, 2, 3] and len(t.items[1:3]) == 2
+
+def test_struct_array_index_error():
+    assert_raises(IndexError, TableStruct(TABLEDATA).items.__getitem__, 4)
+
+def test_struct_array_elements_lazy():
+    t = TableStruct(TABLEDATA)
+    t.items[1]
+    assert [e is not None for e in t.items._elements] == [False, True, False, False]
+
+def test_struct_array_column():
+    t = TableStruct(TABLEDATA)
+    assert t.items.column('kind') == [0, -1, -2, -3] and t.pairs.column('a') == [1, 2]
+    assert t.items._elements == [None] * 4
+
+def test_struct_array_column_changed():
+    t = TableStruct(TABLEDATA)
+    t.items[3].id.value = 30
+    assert t.items.column('id') == [0, 1, 2, 30]
+
+def test_struct_array_pack():
+    t = TableStruct(TABLEDATA)
+    assert t.packed == TABLEDATA
+    t.items[1].kind.value = 5
+    t.items[2] = t.items[1]
+    assert TableStruct(t.packed).items.column('kind') == [0, 5, 5, -3]
+
+def test_struct_array_to_dict():
+    d = TableStruct(TABLEDATA).to_dict()
+    assert d['items'][1] == {'id': 1, 'kind': -1, 'name': "n1\0\0\0\0"} and d['pairs'][0] == {'a': 1, 'b': "x"}
+
+def test_struct_array_lazy():
+    t = TableStruct()
+    t.parse(TABLEDATA, lazy=True)
+    assert t.items[3].kind.value == -3 and t.items.column('id') == [0, 1, 2, 3] and t.packed == TABLEDATA
+
+def test_struct_array_view():
+    buf = bytearray(TABLEDATA)
+    v = TableStruct.view(buf)
+    v.items[0].id.value = 5
+    assert buf[4] == 5 and v.items.column('id') == [5, 1, 2, 3]
+    v.items[3] = TableStruct(TABLEDATA).items[1]
+    assert TableStruct(str(buf)).items[3].kind.value == -1 and v.packed == str(buf)
+
+def test_struct_array_offsetof():
+    assert TableStruct.offsetof('items[2].name') == 34 and TableStruct.offsetof('pairs[1]') == 57
+    assert_raises(NameError, TableStruct.offsetof, 'items[4]')
+    assert_raises(NameError, TableStruct.offsetof, 'items[0].nope')
+
+def test_struct_array_aligned():
+    assert TableStruct(mode=MODE_LP64_ALIGNED).size == 72
+    assert TableStruct.offsetof('pairs[1].b', mode=MODE_LP64_ALIGNED) == 64
+
+def test_struct_array_peek():
+    assert TableStruct.peek(TABLEDATA, 'items[3].id') == 3
+    assert TableStruct.peek(TABLEDATA, 'items').column('name')[1] == "n1\0\0\0\0"
+
+def test_struct_array_scan():
+    assert list(TableStruct.scan(TABLEDATA * 2, ['items[1].kind', 'pairs[0].a'])) == [(-1, 1)] * 2
+
+def test_struct_array_parse_many():
+    cols = TableStruct.parse_many(TABLEDATA * 2)
+    assert list(cols['items[3].id']) == [3, 3] and cols['pairs[1].b'] == ["y", "y"]
+
+def test_struct_array_serialize():
+    l = TableStruct.layout_for()
+    d = StructureLayout.deserialize(l.serialize())
+    assert d.serialize() == l.serialize() and d.format == l.format
+
+def test_struct_array_cache():
+    StructureSet(source=TABLE, cache=cache_dir).struct_named('Table')()
+    s = StructureSet(source=TABLE, cache=cache_dir)
+    assert s.struct_named('Table')(TABLEDATA).items.column('id') == [0, 1, 2, 3] and s._ast is None
+
+def test_struct_array_numpy():
+    if numpy is None:
+        raise SkipTest
+    assert list(TableStruct.frombuffer(TABLEDATA)['items']['kind'][0]) == [0, -1, -2, -3]